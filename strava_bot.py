@@ -3,20 +3,34 @@ import discord
 from discord.ext import commands, tasks
 from discord.utils import get
 import asyncio
+import heapq
 from itertools import cycle
 import random
 import os
 import time
 import datetime
-
-import requests
+import re
+import io
+import math
+import hashlib
+from collections import OrderedDict
+from contextlib import contextmanager
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:     # python < 3.9 (guild time zones fall back to the bot's local time)
+    ZoneInfo = None
+
+import aiohttp
+from aiohttp import web
 import json
-import urllib3
 
 import polyline
 import sqlite3
+import functools
+from concurrent.futures import ProcessPoolExecutor
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+import strava_render
+import strava_geometry
 
 
 
@@ -34,21 +48,24 @@ class NoActivitiesError(Exception):
 # ||||||||||||||||||||||       Database Connection       ||||||||||||||||||||| #
 # ============================================================================ #
 
-# connect to sqlite3 database (create it if it doesnt exist)
-conn = sqlite3.connect('stravaDiscordBot.db')
-# create a cursor for this connection
-c = conn.cursor()
+# sqlite3 database connection and its cursor (opened by openDatabase)
+# (statements are built with bound parameters so they are reused from the statement cache)
+conn = None
+c = None
 
 def create_tables():
     '''Creates tables for storing data in the strava_discord.db database
     
     Included tables in this database are as follows:
             userTokens : user-specific information for identification and authorization
-            userStats : monthly dist, elev, time, and active days statistics
-            userActivities : activity information for all authorized users (includes polyline)
-            dailyActivities : similar to userActivities, but only for today's activities
+            userStats : monthly dist, elev, time, and active days statistics (one row per user per guild)
+            userActivities : activity information for all authorized users (includes the packed route geometry)
+            dailyActivities : per-guild showcase queue of the day's activities (and whether they were showcased)
             routes : various routes and information, including user comments
-            roles : user-specific roles (to change monthly)'''
+            roles : user-specific roles (to change monthly)
+            syncCursors : per-user high-water mark (latest start_date synced) and time of last deep resync
+            activityEmbeds : pre-rendered activity embeds (json) and the map_cache key of their map
+            leaderboardMessages : leaderboard messages posted by the bot (and the sort they show)'''
     
     #create userTokens Table
     c.execute('CREATE TABLE IF NOT EXISTS userTokens(discord_id INTEGER PRIMARY KEY, \
@@ -121,14 +138,671 @@ def create_tables():
                                                         show_freq INTEGER, \
                                                         rec_freq INTEGER, \
                                                         update_freq INTEGER)')
+    #create syncCursors Table
+    c.execute('CREATE TABLE IF NOT EXISTS syncCursors(discord_id INTEGER PRIMARY KEY, \
+                                                      last_start REAL, \
+                                                      last_deep REAL)')
+    #create activityEmbeds Table
+    c.execute('CREATE TABLE IF NOT EXISTS activityEmbeds(activity_id INTEGER PRIMARY KEY, \
+                                                         embed TEXT, \
+                                                         map_key TEXT, \
+                                                         created_at REAL)')
+    #create leaderboardMessages Table
+    c.execute('CREATE TABLE IF NOT EXISTS leaderboardMessages(message_id INTEGER PRIMARY KEY, \
+                                                              channel_id INTEGER, \
+                                                              guild_id INTEGER, \
+                                                              sort TEXT, \
+                                                              posted_at REAL)')
+
+
+# public route catalog: routes that are near-duplicates of each other (same path within
+# route_match_tolerance/route_match_deviation, lengths within route_match_length) share one
+# stored geometry (each route also keeps its own packed geometry in routes.geometry)
+route_simplify_tolerance = 5    # meters, Douglas-Peucker tolerance of stored route geometry
+route_match_tolerance = 30      # meters, max mean distance between two routes that are the same route
+route_match_deviation = 75      # meters, max distance of any point of a route from the same route (no detours)
+route_match_length = 0.1        # max relative difference in length of two routes that are the same route
+route_cell_size = 0.01          # degrees, spatial hash cell of route centroids (candidates come from the 9 nearest cells)
+
+
+def _geometryCandidates(geometry):
+    '''Returns the stored geometries (geom_id, polyline) near a described route (see strava_geometry.describe)
+    with a similar length, the ones that could be the same route'''
+
+    cells = strava_geometry.neighbor_cells(geometry['center_lat'], geometry['center_lon'], route_cell_size)
+    length = geometry['length']
+    return c.execute('SELECT geom_id, polyline FROM routeGeometry WHERE cell IN ({}) AND length BETWEEN ? AND ?'.format(','.join('?'*len(cells))),
+                     tuple(cells) + (length * (1 - route_match_length), length * (1 + route_match_length))).fetchall()
+
+
+def _storeGeometry(geometry, distance):
+    '''Add a described route to routeGeometry (and geometryIndex), returns its geom_id'''
+
+    c.execute('INSERT INTO routeGeometry (polyline, distance, length, center_lat, center_lon, cell) VALUES (?,?,?,?,?,?)',
+              (geometry['polyline'], distance, geometry['length'], geometry['center_lat'], geometry['center_lon'], geometry['cell']))
+    geom_id = c.lastrowid
+    c.execute('INSERT INTO geometryIndex (geom_id, min_lat, max_lat, min_lon, max_lon) VALUES (?,?,?,?,?)',
+              (geom_id, geometry['min_lat'], geometry['max_lat'], geometry['min_lon'], geometry['max_lon']))
+    return geom_id
+
+
+def _catalogGeometry(poly, distance):
+    '''Find the stored geometry of a route (adding it to routeGeometry if it is a new route)
+
+    (runs inline, for migrations and startup, the bot uses _catalogRoute)
+
+    Inputs
+        poly : encoded polyline of the route
+        distance : distance of the route (m, as reported by strava)
+    Returns
+        geom_id : id of the route's geometry (None if the polyline is empty)
+    '''
+
+    geometry = strava_geometry.describe(poly, route_simplify_tolerance, route_cell_size)
+    if geometry is None:
+        return None
+    geom_id = strava_geometry.find_match(geometry['polyline'], _geometryCandidates(geometry),
+                                         route_match_tolerance, route_match_deviation)
+    if geom_id is None:
+        geom_id = _storeGeometry(geometry, distance)
+    return geom_id
+
+
+def _catalogRoutes():
+    '''Add the polylines of routes that are not in the catalog yet to routeGeometry
+
+    (routes written straight to the database, e.g. by addRoute_tool, or from before the catalog,
+     each route keeps its own polyline, see _packRoutes)
+
+    Returns
+        count : number of routes added to the catalog
+    '''
+
+    rows = c.execute('SELECT route_id, polyline, distance FROM routes WHERE geom_id IS NULL AND polyline IS NOT NULL').fetchall()
+    count = 0
+    for route_id, poly, distance in rows:
+        try:
+            geom_id = _catalogGeometry(poly, distance)
+        except Exception as e:
+            print('Could not add route {} to the catalog ({})'.format(route_id, e))
+            geom_id = None
+        if geom_id is None:
+            continue
+        c.execute('UPDATE routes SET geom_id = ? WHERE route_id = ?', (geom_id, route_id))
+        count += 1
+    return count
+
+
+def _packRoutes():
+    '''Move the polylines of cataloged routes into the compact geometry column (see strava_geometry.pack)
+
+    (routes that could not be cataloged keep their polyline text, so they are tried again at startup)
+
+    Returns
+        count : number of routes packed
+    '''
+
+    rows = c.execute('SELECT route_id, polyline FROM routes WHERE geom_id IS NOT NULL AND polyline IS NOT NULL').fetchall()
+    c.executemany('UPDATE routes SET geometry = ?, polyline = NULL WHERE route_id = ?',
+                  [(strava_geometry.pack_polyline(poly), route_id) for route_id, poly in rows])
+    return len(rows)
+
+
+def _packActivities():
+    '''Move userActivities polylines into the compact geometry column (see strava_geometry.pack)
+
+    Returns
+        count : number of activities packed
+    '''
+
+    rows = c.execute('SELECT activity_id, polyline FROM userActivities WHERE polyline IS NOT NULL').fetchall()
+    c.executemany('UPDATE userActivities SET geometry = ?, polyline = NULL WHERE activity_id = ?',
+                  [(strava_geometry.pack_polyline(poly), activity_id) for activity_id, poly in rows])
+    return len(rows)
+
+
+# ordered schema upgrades applied on top of create_tables (version, description, statements)
+# (add new steps to the end, never edit a step that has been released)
+migrations = [
+    (1, 'secondary indexes for the hot queries',
+     ['CREATE INDEX IF NOT EXISTS userActivities_user_month ON userActivities(discord_id, year, month, type)',
+      'CREATE INDEX IF NOT EXISTS userActivities_date ON userActivities(year, month, day, discord_id)',
+      'CREATE INDEX IF NOT EXISTS idTable_guild ON _idTable(guild_id, discord_id)',
+      'CREATE INDEX IF NOT EXISTS idTable_discord ON _idTable(discord_id)',
+      'CREATE INDEX IF NOT EXISTS idTable_strava ON _idTable(strava_id)',
+      'CREATE INDEX IF NOT EXISTS userStats_guild ON userStats(guild_id, discord_id)',
+      'CREATE INDEX IF NOT EXISTS userStats_discord ON userStats(discord_id)',
+      'CREATE INDEX IF NOT EXISTS dailyActivities_guild ON dailyActivities(guild_id)',
+      'CREATE INDEX IF NOT EXISTS routes_guild ON routes(guild_id, distance)']),
+    (2, 'one userStats row per user/guild with a distinct-day bitmap',
+     ['DELETE FROM userStats WHERE rowid NOT IN (SELECT MAX(rowid) FROM userStats GROUP BY discord_id, guild_id)',
+      'ALTER TABLE userStats ADD COLUMN day_mask INTEGER DEFAULT 0',
+      'CREATE UNIQUE INDEX IF NOT EXISTS userStats_user_guild ON userStats(discord_id, guild_id)',
+      # rebuild the totals of every guild with settings along with the mask (same as _updateUserStats),
+      # so the incremental updates start from totals that match it
+      # (bit n of day_mask is set when the user has a (counted) activity on day n of the current month)
+      'DELETE FROM userStats WHERE guild_id IN (SELECT guild_id FROM guildSettings)',
+      "INSERT INTO userStats (discord_id, dist, time, elev, days, day_mask, guild_id) \
+       SELECT a.discord_id, SUM(a.distance), SUM(a.moving_time), SUM(a.elev_gain), COUNT(DISTINCT a.day), \
+              SUM(DISTINCT 1 << a.day), g.guild_id \
+       FROM guildSettings g, userActivities a \
+       WHERE a.discord_id IN (SELECT discord_id FROM _idTable WHERE guild_id = g.guild_id) \
+       AND a.month = CAST(strftime('%m', 'now', 'localtime') AS INTEGER) \
+       AND a.year = CAST(strftime('%Y', 'now', 'localtime') AS INTEGER) \
+       AND instr(',' || g.types || ',', ',' || a.type || ',') > 0 \
+       GROUP BY g.guild_id, a.discord_id"]),
+    (3, 'public route catalog (one stored geometry per distinct route, indexed by bounding box, '
+        'each route keeps its own packed geometry)',
+     ['CREATE TABLE IF NOT EXISTS routeGeometry(geom_id INTEGER PRIMARY KEY, polyline TEXT, distance REAL, length REAL, \
+                                                center_lat REAL, center_lon REAL, cell TEXT)',
+      'CREATE INDEX IF NOT EXISTS routeGeometry_cell ON routeGeometry(cell, length)',
+      'CREATE VIRTUAL TABLE IF NOT EXISTS geometryIndex USING rtree(geom_id, min_lat, max_lat, min_lon, max_lon)',
+      'ALTER TABLE routes ADD COLUMN geom_id INTEGER',
+      'ALTER TABLE routes ADD COLUMN geometry BLOB',
+      'CREATE INDEX IF NOT EXISTS routes_geom ON routes(geom_id, guild_id)',
+      _catalogRoutes,
+      _packRoutes]),
+    (4, 'compact activity geometry (packed int32 deltas instead of polyline text)',
+     ['ALTER TABLE userActivities ADD COLUMN geometry BLOB',
+      _packActivities]),
+    (5, 'per-guild showcase queue (one dailyActivities row per guild/activity with a showcased flag) and guild time zones',
+     ['CREATE TABLE dailyActivities_new(guild_id INTEGER, activity_id INTEGER, discord_id INTEGER, local_date TEXT, \
+                                        showcased INTEGER DEFAULT 0, PRIMARY KEY (guild_id, activity_id))',
+      "INSERT OR IGNORE INTO dailyActivities_new (guild_id, activity_id, discord_id, local_date) \
+       SELECT guild_id, activity_id, discord_id, date('now', 'localtime') FROM dailyActivities",
+      'DROP TABLE dailyActivities',
+      'ALTER TABLE dailyActivities_new RENAME TO dailyActivities',
+      'CREATE INDEX IF NOT EXISTS dailyActivities_activity ON dailyActivities(activity_id)',
+      'ALTER TABLE guildSettings ADD COLUMN tz TEXT']),
+    (6, 'bot state (month of the last monthly reset, so a reset missed while offline is caught up)',
+     ['CREATE TABLE IF NOT EXISTS botState(name TEXT PRIMARY KEY, value TEXT)',
+      "INSERT OR IGNORE INTO botState (name, value) VALUES ('last_reset', strftime('%Y-%m', 'now', 'localtime'))"]),
+]
+
+
+def migrate():
+    '''Bring the database schema up to the latest version in migrations
+
+    The current version is kept in the _schemaVersion table. Each step runs
+    in its own transaction, so a failed upgrade leaves the database at the last good version.
+    '''
+
+    c.execute('CREATE TABLE IF NOT EXISTS _schemaVersion(version INTEGER)')
+    row = c.execute('SELECT MAX(version) FROM _schemaVersion').fetchone()
+    current = row[0] if row[0] != None else 0
+
+    for version, description, statements in migrations:
+        if version <= current:
+            continue
+        try:
+            c.execute('BEGIN')
+            for each in statements:
+                if callable(each):
+                    each()
+                else:
+                    c.execute(each)
+            c.execute('INSERT INTO _schemaVersion (version) VALUES (?)', (version,))
+            conn.commit()
+        except:
+            conn.rollback()
+            print('Schema migration {} failed ({})'.format(version, description))
+            raise
+        print('Applied schema migration {}: {}'.format(version, description))
+
+
+def openDatabase(path='stravaDiscordBot.db'):
+    '''Connect to the sqlite3 database (create it if it doesnt exist) and bring its schema up to date'''
+
+    global conn, c
+    conn = sqlite3.connect(path, cached_statements=256)
+    c = conn.cursor()
+    # (used by route queries to check the distance of route centroids from a club center)
+    conn.create_function('haversine', 4, _haversine, deterministic=True)
+    create_tables()
+    migrate()
+    _catalogRoutes()
+    _packRoutes()
+    conn.commit()
+
+
+# ============================================================================ #
+# ||||||||||||||||||||||        Async HTTP Client        ||||||||||||||||||||| #
+# ============================================================================ #
+
+# every strava/google maps call goes through one pooled keep-alive session so a slow
+# response only suspends the coroutine waiting on it (not the whole discord gateway)
+http_total_timeout = 30     # seconds allowed for a full request (connect + read)
+http_connect_timeout = 10   # seconds allowed to open a connection
+http_conn_limit = 100       # max simultaneous connections (all hosts)
+http_host_limit = 10        # max simultaneous connections to a single host
+
+_http_session = None
+
+# priorities for strava api requests (lower value goes first when the quota is tight)
+PRIORITY_INTERACTIVE = 0    # user commands ($strava authorize, $strava ua, ...)
+PRIORITY_BACKGROUND = 1     # looping/background syncs
+
+
+class RateLimitGovernor:
+    '''Keeps strava api requests inside the 15-minute and daily quotas
+
+    Each window is a bucket of request tokens that refills when the window resets
+    (every 15 minutes on the quarter hour, and daily at midnight UTC). Usage is
+    counted locally as requests are made and corrected from the X-RateLimit-Limit and
+    X-RateLimit-Usage headers of every strava response. When a bucket is empty the
+    callers wait (queued by priority) until it refills. Background requests are also
+    held back from the last `reserve` fraction of each bucket so interactive commands
+    can still go through.
+
+    Inputs
+        limits (optional) : [15-minute limit, daily limit] (updated from the response headers)
+        reserve (optional) : fraction of each bucket only usable by interactive requests
+    '''
+
+    windows = (900, 86400)
+
+    def __init__(self, limits=(100, 1000), reserve=0.1):
+        self.limits = list(limits)
+        self.usage = [0, 0]
+        self.reserve = reserve
+        self._resets = [self._nextReset(w) for w in self.windows]
+        self._waiters = []      # heap of (priority, seq, future)
+        self._seq = 0
+        self._wake = None
+
+    @staticmethod
+    def _nextReset(window, now=None):
+        now = time.time() if now is None else now
+        return (now // window + 1) * window
+
+    def _roll(self):
+        '''Refill any bucket whose window has reset'''
+        now = time.time()
+        for i, window in enumerate(self.windows):
+            if now >= self._resets[i]:
+                self.usage[i] = 0
+                self._resets[i] = self._nextReset(window, now)
+
+    def _available(self, priority):
+        '''Number of requests the given priority may still make in the current windows'''
+        available = []
+        for i in range(len(self.windows)):
+            limit = self.limits[i]
+            if priority != PRIORITY_INTERACTIVE:
+                limit -= int(limit * self.reserve)
+            available.append(limit - self.usage[i])
+        return min(available)
+
+    def _dispatch(self):
+        '''Release queued callers (highest priority first) while the buckets allow it'''
+        if self._wake is not None:
+            self._wake.cancel()
+            self._wake = None
+        self._roll()
+        while len(self._waiters) > 0:
+            priority, seq, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if self._available(priority) <= 0:
+                break
+            heapq.heappop(self._waiters)
+            self.usage = [x + 1 for x in self.usage]
+            future.set_result(None)
+
+        if len(self._waiters) > 0 and self._wake is None:
+            # wait for the next window to reset (plus a second for clock skew)
+            delay = max(0, min(self._resets) - time.time()) + 1
+            self._wake = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    async def acquire(self, priority=PRIORITY_INTERACTIVE):
+        '''Wait until a request of the given priority fits in the quota'''
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, future))
+        self._dispatch()
+        await future
+
+    def update(self, headers):
+        '''Correct the limits/usage from the rate limit headers of a strava response'''
+        try:
+            limits = [int(x) for x in headers['X-RateLimit-Limit'].split(',')]
+            usage = [int(x) for x in headers['X-RateLimit-Usage'].split(',')]
+        except (KeyError, ValueError):
+            return
+        self._roll()
+        self.limits[:len(limits)] = limits[:len(self.limits)]
+        self.usage[:len(usage)] = usage[:len(self.usage)]
+        self._dispatch()
+
+    def exhaust(self):
+        '''Mark the current 15-minute window as used up (after a 429 response)'''
+        self._roll()
+        self.usage[0] = max(self.usage[0], self.limits[0])
+
+    def headroom(self):
+        '''Returns the remaining requests, limit, and seconds until reset of each window'''
+        self._roll()
+        now = time.time()
+        return {name: {'remaining': max(0, self.limits[i] - self.usage[i]),
+                       'limit': self.limits[i],
+                       'reset_in': int(self._resets[i] - now)}
+                for i, name in enumerate(['15min', 'daily'])}
+
+    def queued(self):
+        '''Returns the number of callers waiting on the quota'''
+        return len([x for x in self._waiters if not x[2].done()])
+
+
+strava_governor = RateLimitGovernor()
+
+
+class HTTPResponse:
+    '''Fully-read http response (the connection is returned to the pool before this is created)'''
+    __slots__ = ('status', 'headers', 'content')
+
+    def __init__(self, status, headers, content):
+        self.status = status
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def _httpSession():
+    '''Returns the shared aiohttp session (created lazily so it is bound to the running event loop)'''
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(limit=http_conn_limit,
+                                         limit_per_host=http_host_limit,
+                                         ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(total=http_total_timeout,
+                                        sock_connect=http_connect_timeout)
+        _http_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _http_session
+
+
+def _httpParams(params):
+    '''Convert a requests-style params dict (list values = repeated keys) into aiohttp query pairs'''
+    if params is None:
+        return None
+    pairs = []
+    for key, value in params.items():
+        for each in (value if isinstance(value, (list, tuple)) else [value]):
+            pairs.append((key, str(each)))
+    return pairs
+
+
+async def httpRequest(method, url, headers=None, params=None, data=None, verify=True, priority=PRIORITY_INTERACTIVE):
+    '''Make a non-blocking http request through the shared session
+
+    Requests to strava wait on strava_governor so they stay inside the api quota
+
+    Inputs
+        method : http method ('GET', 'POST', ...)
+        url : url to make the request to
+        headers (optional) : dict of request headers
+        params (optional) : dict of query parameters (list values are sent as repeated keys)
+        data (optional) : form data for the request body
+        verify (optional) : verify the ssl certificate of the host
+        priority (optional) : PRIORITY_INTERACTIVE or PRIORITY_BACKGROUND (strava requests only)
+    Returns
+        response : HTTPResponse holding the status, headers, and body of the response
+    '''
+
+    is_strava = 'strava.com/' in url
+    session = _httpSession()
+
+    # a 429 from strava is retried once the governor lets the request through again
+    for attempt in range(2):
+        if is_strava:
+            await strava_governor.acquire(priority)
+
+        async with session.request(method, url, headers=headers, params=_httpParams(params),
+                                   data=data, ssl=None if verify else False) as res:
+            content = await res.read()
+            response = HTTPResponse(res.status, res.headers, content)
+
+        if not is_strava:
+            break
+        strava_governor.update(response.headers)
+        if response.status != 429:
+            break
+        print('Strava rate limit reached, holding requests until the window resets')
+        strava_governor.exhaust()
+    return response
+
+
+async def httpGet(url, headers=None, params=None, priority=PRIORITY_INTERACTIVE):
+    '''Non-blocking GET request (see httpRequest)'''
+    return await httpRequest('GET', url, headers=headers, params=params, priority=priority)
+
+
+async def httpPost(url, data=None, headers=None, verify=True, priority=PRIORITY_INTERACTIVE):
+    '''Non-blocking POST request (see httpRequest)'''
+    return await httpRequest('POST', url, headers=headers, data=data, verify=verify, priority=priority)
+
+
+async def httpClose():
+    '''Close the shared session (and all pooled connections)'''
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+
+# ============================================================================ #
+# ||||||||||||||||||||||          Compute Pool           ||||||||||||||||||||| #
+# ============================================================================ #
+
+# cpu-bound work (map rendering/polyline decoding, large leaderboards) runs in worker
+# processes so it never blocks the event loop (and the discord gateway heartbeat)
+compute_workers = int(os.environ.get('STRAVA_COMPUTE_WORKERS', min(4, os.cpu_count() or 1)))
+compute_offload_rows = 100      # leaderboards with fewer users than this are built inline
+
+_compute_pool = None
+
+
+def _computePool():
+    '''Returns the shared worker process pool (created on first use, None if compute_workers is 0)'''
+    global _compute_pool
+    if _compute_pool is None and compute_workers > 0:
+        _compute_pool = ProcessPoolExecutor(max_workers=compute_workers)
+    return _compute_pool
+
+
+async def runCompute(func, *args, **kwargs):
+    '''Run a cpu-bound function in the compute pool and wait for its result
+
+    func must be importable by the workers without this module (functions of strava_render
+    or strava_geometry, the workers never run init()).
+    With compute_workers = 0 it runs in the default thread pool instead.
+
+    Inputs
+        func : function to run
+        args, kwargs : arguments of func (must be picklable)
+    Returns
+        result : the return value of func
+    '''
+
+    call = functools.partial(func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(_computePool(), call)
+
+
+def computeClose():
+    '''Shut down the compute pool (and its worker processes)'''
+    global _compute_pool
+    if _compute_pool is not None:
+        _compute_pool.shutdown(wait=False, cancel_futures=True)
+    _compute_pool = None
+
+
+# ============================================================================ #
+# ||||||||||||||||||||||         Map Image Cache         ||||||||||||||||||||| #
+# ============================================================================ #
+
+# rendered maps are keyed by a hash of everything that goes into the image (polylines,
+# colors, maptype, size), so an activity/route map is only ever requested from google once
+map_cache_dir = 'obj/mapcache'
+map_cache_memory_entries = 64           # number of images kept in memory (most recently used)
+map_cache_disk_budget = 200*1024*1024   # max bytes of images kept in map_cache_dir
+
+# 'google' (static maps api) or 'local' (drawn in-process by strava_render, needs Pillow)
+map_renderer = os.environ.get('STRAVA_MAP_RENDERER', 'google')
+map_tile_dir = 'obj/maptiles'   # optional locally saved tiles for the local renderer
+if map_renderer == 'local' and not strava_render.available():
+    print('Pillow is not installed, using google static maps')
+    map_renderer = 'google'
+
+
+class MapCache:
+    '''Two-tier (memory, disk) LRU cache of rendered map images
+
+    The memory tier is an OrderedDict holding the most recently used images. The disk
+    tier keeps every image as {key}.png in `directory`; the mtime of a file is bumped on
+    every hit, so when the directory grows past `disk_budget` bytes the least recently
+    used files are removed first.
+
+    Inputs
+        directory : folder for the on-disk tier
+        memory_entries (optional) : max number of images held in memory
+        disk_budget (optional) : max total bytes of the on-disk tier
+    '''
+
+    def __init__(self, directory, memory_entries=64, disk_budget=200*1024*1024):
+        self.directory = directory
+        self.memory_entries = memory_entries
+        self.disk_budget = disk_budget
+        self._memory = OrderedDict()
+        self._disk_bytes = None     # total size of the disk tier (scanned on first use)
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+
+    @staticmethod
+    def key(*parts):
+        '''Returns the cache key (sha1 hex digest) of the given image parameters'''
+        return hashlib.sha1(json.dumps(parts).encode()).hexdigest()
+
+    def path(self, key):
+        '''Returns the on-disk location of an image'''
+        return os.path.join(self.directory, key + '.png')
+
+    def _remember(self, key, data):
+        self._memory[key] = data
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        '''Returns the cached image bytes (None on a miss)'''
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.counters['memory_hits'] += 1
+            return self._memory[key]
+
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+            os.utime(self.path(key))
+        except OSError:
+            self.counters['misses'] += 1
+            return None
+        self.counters['disk_hits'] += 1
+        self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        '''Store image bytes in both tiers (then evict from disk if over budget)'''
+        self._remember(key, data)
+        os.makedirs(self.directory, exist_ok=True)
+        if self._disk_bytes is None:
+            self._disk_bytes = sum(size for name, size, mtime in self._files())
+
+        # write to a temporary file first so a crash never leaves a partial image behind
+        path = self.path(key)
+        old_size = os.path.getsize(path) if os.path.isfile(path) else 0
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+        self._disk_bytes += len(data) - old_size
+
+        if self._disk_bytes > self.disk_budget:
+            self._evict()
+
+    def _files(self):
+        '''Returns (name, size, mtime) of each image in the disk tier'''
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.png'):
+                stat = entry.stat()
+                files.append((entry.name, stat.st_size, stat.st_mtime))
+        return files
+
+    def _evict(self):
+        '''Remove least recently used images until the disk tier fits in its budget'''
+        files = sorted(self._files(), key=lambda x: x[2])
+        self._disk_bytes = sum(x[1] for x in files)
+        for name, size, mtime in files:
+            if self._disk_bytes <= self.disk_budget:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            self._disk_bytes -= size
+            self.counters['evictions'] += 1
+
+    def stats(self):
+        '''Returns the hit/miss counters and current size of each tier'''
+        if self._disk_bytes is None and os.path.isdir(self.directory):
+            self._disk_bytes = sum(size for name, size, mtime in self._files())
+        lookups = self.counters['memory_hits'] + self.counters['disk_hits'] + self.counters['misses']
+        stats = dict(self.counters)
+        stats['hit_rate'] = (lookups - self.counters['misses']) / lookups if lookups > 0 else 0
+        stats['memory_entries'] = len(self._memory)
+        stats['disk_bytes'] = self._disk_bytes or 0
+        return stats
+
+
+map_cache = MapCache(map_cache_dir, map_cache_memory_entries, map_cache_disk_budget)
 
 
-create_tables()
 # ============================================================================ #
 # |||||||||||||||||||||||       Helper Functions       ||||||||||||||||||||||| #
 # ============================================================================ #
 
+# depth of nested transaction() blocks (commits are deferred while > 0)
+_txn_depth = 0
+
+
+@contextmanager
+def transaction():
+    '''Group database writes into a single commit
+
+    The data* helpers commit after each call unless they run inside a transaction() block,
+    in which case everything is committed once when the outermost block exits (or rolled
+    back if it raises). Blocks can be nested. Do not await inside a block (other coroutines
+    would write into the same transaction).
+    '''
+
+    global _txn_depth
+    _txn_depth += 1
+    try:
+        yield
+    except BaseException:
+        _txn_depth -= 1
+        if _txn_depth == 0:
+            conn.rollback()
+        raise
+    _txn_depth -= 1
+    if _txn_depth == 0:
+        conn.commit()
+
 
+def _commit():
+    '''Commit unless inside a transaction() block'''
+    if _txn_depth == 0:
+        conn.commit()
 
 
 def dataEntry(tableName, dict):
@@ -139,11 +813,98 @@ def dataEntry(tableName, dict):
         dict : dictionary to insert into database table
     '''
 
-    sql = 'INSERT OR REPLACE INTO {} ({}) VALUES ({});'.format(tableName,
-                                                    ','.join(dict.keys()),
+    sql = 'INSERT OR REPLACE INTO {} ({}) VALUES ({});'.format(_sqlName(tableName),
+                                                    ','.join([_sqlName(x) for x in dict.keys()]),
                                                     ','.join(['?']*len(dict)))
     c.execute(sql, tuple(dict.values()))
-    conn.commit()
+    _commit()
+
+
+def dataEntryMany(tableName, dict_list):
+    '''Insert (upsert) a list of dicts (all with the same keys) into a sqlite3 database with a single statement
+    
+    Inputs
+        tableName : name of table to insert dicts into
+        dict_list : list of dictionaries to insert into database table
+    '''
+
+    if len(dict_list) <= 0:
+        return
+    keys = list(dict_list[0].keys())
+    sql = 'INSERT OR REPLACE INTO {} ({}) VALUES ({});'.format(_sqlName(tableName),
+                                                    ','.join([_sqlName(x) for x in keys]),
+                                                    ','.join(['?']*len(keys)))
+    c.executemany(sql, [tuple(each[key] for key in keys) for each in dict_list])
+    _commit()
+
+
+_sql_ineqs = ['<','>','=','!=','<=','>=','IN','NOT IN','IS','IS NOT']
+_sql_name = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def _sqlName(name):
+    '''Check that a table/column name is a plain identifier (names can not be bound as parameters)'''
+    if not _sql_name.match(str(name)):
+        raise ValueError('Bad sql identifier: {}'.format(name))
+    return name
+
+
+def _sqlCondition(key, ineq, value):
+    '''Build a single parameterized condition
+
+    IN lists are padded (repeating the last value) to a power of two length so that
+    lists of similar size share one cached statement
+
+    Returns
+        sql : condition with ? placeholders (ex: 'discord_id IN (?,?,?,?)')
+        params : list of values bound to the placeholders
+    '''
+
+    if ineq not in _sql_ineqs:
+        raise ValueError('Bad sql inequality: {}'.format(ineq))
+    _sqlName(key)
+
+    if ineq in ['IN','NOT IN']:
+        values = list(value)
+        if len(values) <= 0:
+            # nothing can be IN an empty list
+            return ('0' if ineq == 'IN' else '1'), []
+        size = 1
+        while size < len(values):
+            size *= 2
+        values += [values[-1]] * (size - len(values))
+        return '{} {} ({})'.format(key, ineq, ','.join(['?']*size)), values
+    if value is None:
+        return '{} {} NULL'.format(key, 'IS NOT' if ineq in ['!=','IS NOT'] else 'IS'), []
+    return '{} {} ?'.format(key, ineq), [value]
+
+
+def _sqlWhere(cond_key=None, cond_ineq=None, cond_value=None, extra_cond=None):
+    '''Build a parameterized WHERE clause from the data* helper conditionals
+
+    Inputs
+        cond_key, cond_ineq, cond_value : main conditional (ex: 'guild_id', '=', 1234)
+        extra_cond : list of extra (key, ineq, value) conditionals joined with AND
+                     (ex: [('month', '=', 5), ('type', 'IN', ['Run','Walk'])])
+    Returns
+        sql : ' WHERE ...' (or '' if there are no conditionals)
+        params : list of values bound to the placeholders
+    '''
+
+    conditions = []
+    if cond_key != None:
+        conditions.append((cond_key, cond_ineq, cond_value))
+    if extra_cond != None:
+        conditions += list(extra_cond)
+    if len(conditions) <= 0:
+        return '', []
+
+    sql, params = [], []
+    for key, ineq, value in conditions:
+        cond_sql, cond_params = _sqlCondition(key, ineq, value)
+        sql.append(cond_sql)
+        params += cond_params
+    return ' WHERE ' + ' AND '.join(sql), params
 
 
 def dataRead(tableName, des_vals, cond_key=None, cond_ineq=None, cond_value=None, fetchOne=False, extra_cond=None):
@@ -153,16 +914,14 @@ def dataRead(tableName, des_vals, cond_key=None, cond_ineq=None, cond_value=None
         tableName : name of table to insert dict into
         des_vals : desired returned values in a row of the table (type: list)
         cond_key : table column key to query with a conditional
-        cond_ineq : inequality to use in conditional (==, <, >, <=, >=, !=)
-        cond_value : value of ineqality in conditional
+        cond_ineq : inequality to use in conditional (=, <, >, <=, >=, !=, IN, NOT IN, IS, IS NOT)
+        cond_value : value of ineqality in conditional (list of values for IN)
+        extra_cond : list of extra (key, ineq, value) conditionals
     '''
 
-    exec_str = 'SELECT {} FROM {}'.format(','.join(des_vals), tableName)
-    if cond_key != None and cond_ineq in ['<','>','=','!=','<=','>='] and cond_value != None:
-        exec_str +=  ' WHERE {} {} {}'.format(cond_key, cond_ineq, cond_value)
-        if extra_cond != None:
-                    exec_str += ' AND {}'.format(extra_cond)
-    c.execute(exec_str)
+    where, params = _sqlWhere(cond_key, cond_ineq, cond_value, extra_cond)
+    exec_str = 'SELECT {} FROM {}{}'.format(','.join(des_vals), _sqlName(tableName), where)
+    c.execute(exec_str, params)
 
     if fetchOne:
         return c.fetchone()
@@ -171,95 +930,240 @@ def dataRead(tableName, des_vals, cond_key=None, cond_ineq=None, cond_value=None
 
 
 def dataUpdate(tableName, des_vals, update_vals, cond_key=None, cond_ineq=None, cond_value=None, extra_cond=None):
-    '''Updates rows in a database table
+    '''Updates rows in a database table (all columns in a single statement)
         
     Inputs
         tableName : name of table to insert dict into
-        des_vals : desired returned values in a row of the table (type: list)
+        des_vals : columns to update (type: list)
+        update_vals : new values of the columns (type: list, same order as des_vals)
         cond_key : table column key to query with a conditional
-        cond_ineq : inequality to use in conditional (==, <, >, <=, >=, !=)
-        cond_value : value of ineqality in conditional
-    '''
-
-    c.execute('SELECT * FROM {}'.format(tableName))
-    if len(des_vals) == len(update_vals):
-        for i in range(len(des_vals)):
-            exec_str = 'UPDATE {} SET {} = {}'.format(tableName, des_vals[i], update_vals[i])
-            if cond_key != None and cond_ineq in ['<','>','=','!=','<=','>='] and cond_value != None:
-                exec_str +=  ' WHERE {} {} {}'.format(cond_key, cond_ineq, cond_value)
-                if extra_cond != None:
-                    exec_str += ' AND {}'.format(extra_cond)
-            c.execute(exec_str)
-            conn.commit()
+        cond_ineq : inequality to use in conditional (=, <, >, <=, >=, !=, IN, NOT IN, IS, IS NOT)
+        cond_value : value of ineqality in conditional (list of values for IN)
+        extra_cond : list of extra (key, ineq, value) conditionals
+    '''
+
+    if len(des_vals) != len(update_vals) or len(des_vals) <= 0:
+        return
+    where, params = _sqlWhere(cond_key, cond_ineq, cond_value, extra_cond)
+    exec_str = 'UPDATE {} SET {}{}'.format(_sqlName(tableName),
+                                           ', '.join(['{} = ?'.format(_sqlName(x)) for x in des_vals]),
+                                           where)
+    c.execute(exec_str, list(update_vals) + params)
+    _commit()
 
 
-def dataDelete(tableName, cond_key=None, cond_ineq=None, cond_value=None):
+def dataDelete(tableName, cond_key=None, cond_ineq=None, cond_value=None, extra_cond=None):
     '''Deletes rows in a database table
         
     Inputs
         tableName : name of table to insert dict into
         cond_key : table column key to query with a conditional
-        cond_ineq : inequality to use in conditional (==, <, >, <=, >=, !=)
-        cond_value : value of ineqality in conditional
+        cond_ineq : inequality to use in conditional (=, <, >, <=, >=, !=, IN, NOT IN, IS, IS NOT)
+        cond_value : value of ineqality in conditional (list of values for IN)
+        extra_cond : list of extra (key, ineq, value) conditionals
     '''
 
-    exec_str = 'DELETE FROM {}'.format(tableName)
-    if cond_key != None and cond_ineq in ['<','>','=','!=','<=','>='] and cond_value != None:
-                exec_str +=  ' WHERE {} {} {}'.format(cond_key, cond_ineq, cond_value)
-    c.execute(exec_str)
-    conn.commit()
+    where, params = _sqlWhere(cond_key, cond_ineq, cond_value, extra_cond)
+    c.execute('DELETE FROM {}{}'.format(_sqlName(tableName), where), params)
+    _commit()
 
 
-def poly_toMap(activity_id, poly, maptype='roadmap'):
-    '''Create a map image from a given polyline using google map api
-    
+class GuildSettings:
+    '''Settings of a guild (one guildSettings row, with parsed values)
+
+    types is a set of activity types, channel ids and frequencies are ints, tz is an IANA time
+    zone name, and settings that were never set are None. Use _updateGuildSettings to change them.
+    '''
+    __slots__ = ('guild_id', 'types', 'lead_id', 'show_id', 'rec_id', 'lat_lon_center',
+                 'lead_freq', 'show_freq', 'rec_freq', 'update_freq', 'tz')
+
+    def __init__(self, guild_id, **values):
+        self.guild_id = guild_id
+        for name in self.__slots__[1:]:
+            setattr(self, name, self.parse(name, values.get(name)))
+
+    @staticmethod
+    def parse(name, value):
+        '''Convert a guildSettings column value (or a new setting value) into a setting'''
+        if name == 'types':
+            if isinstance(value, str):
+                return set(x for x in value.split(',') if len(x) > 0)
+            return set(value or [])
+        if value in [None, 'None', '']:
+            return None
+        if name in ['lat_lon_center', 'tz']:
+            return str(value)
+        return int(value)
+
+    def center(self):
+        '''Returns the club center as a (lat, lon) tuple (None if it has not been set)'''
+        try:
+            lat, lon = self.lat_lon_center.split(',')
+            return float(lat), float(lon)
+        except (AttributeError, ValueError):
+            return None
+
+    def column(self, name):
+        '''Returns the guildSettings column value of a setting'''
+        value = getattr(self, name)
+        if name == 'types':
+            return ','.join(sorted(value)) if len(value) > 0 else None
+        return value
+
+
+_guild_settings = None  # guild_id : GuildSettings (mirrors guildSettings, loaded on first use)
+
+
+def _guildSettingsCache():
+    '''Returns the settings of every guild (loaded from guildSettings on first use)'''
+
+    global _guild_settings
+    if _guild_settings is None:
+        cols = list(GuildSettings.__slots__)
+        _guild_settings = {row[0]: GuildSettings(row[0], **dict(zip(cols[1:], row[1:])))
+                           for row in dataRead('guildSettings', cols)}
+    return _guild_settings
+
+
+def _guildSettings(guild_id):
+    '''Returns the GuildSettings of a guild (None if the guild has no settings)'''
+    return _guildSettingsCache().get(guild_id)
+
+
+def _updateGuildSettings(guild_id, values):
+    '''Change settings of a guild (creates its settings if it has none)
+
+    The cached settings are updated and only the changed columns are written to guildSettings
+
     Inputs
-        activity_id : id of the activity (for file save purposes)
-        poly : the polyline of the activity
-        maptype : type of map type (roadmap, satellite, hybrid, terrain)
+        guild_id : (server_id) id number of the guild
+        values : dictionary of setting name : new value (types as a set/list of activity types)
+    Returns
+        settings : the guild's GuildSettings
     '''
 
-    url = "https://maps.googleapis.com/maps/api/staticmap?"
-    m_size = '640x640'
-    param = {'size': m_size, 'maptype': maptype, 'path':'enc:{}'.format(poly), 'key':g_api_key}
+    cache = _guildSettingsCache()
+    settings = cache.get(guild_id)
+    if settings is None:
+        settings = GuildSettings(guild_id)
+        dataEntry('guildSettings', {'guild_id': guild_id})
+        cache[guild_id] = settings
+
+    changed = {}
+    for name in values:
+        if name not in GuildSettings.__slots__[1:]:
+            raise ValueError('Unknown guild setting: {}'.format(name))
+        value = GuildSettings.parse(name, values[name])
+        if getattr(settings, name) != value:
+            setattr(settings, name, value)
+            changed[name] = settings.column(name)
+    if len(changed) > 0:
+        dataUpdate('guildSettings', list(changed), list(changed.values()),
+                   cond_key='guild_id', cond_ineq='=', cond_value=guild_id)
+    return settings
 
-    map_r = requests.get(url, headers=None, params=param)
-    
-    # save map image to /obj/activitymaps with name based on activity id and maptype
-    with open('obj/activitymaps/{}_{}.png'.format(activity_id, maptype), 'wb') as f:
-        f.write(map_r.content)
-    return map_r
 
+def _haversine(lat1, lon1, lat2, lon2):
+    '''Great circle distance (km) between two lat/lon points'''
 
-def multiPoly_toMap(filename, poly_list, maptype='roadmap', m_size='640x640'):
-    '''Create a map image from multiple polylines using google map api
+    d_lat = math.radians(lat2 - lat1)
+    d_lon = math.radians(lon2 - lon1)
+    a = math.sin(d_lat/2)**2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(d_lon/2)**2
+    return 2 * 6371.0 * math.asin(math.sqrt(a))
+
+
+def _mapKey(poly_list, colors, maptype, m_size, renderer=None):
+    '''Returns the map_cache key of a map image drawn by renderer (default: map_renderer)'''
+    return MapCache.key(renderer or map_renderer, poly_list, colors, maptype, m_size)
+
+
+async def _renderMap(poly_list, colors, maptype, m_size):
+    '''Returns the png bytes of a map of the given polylines and its map_cache key (None, None if it failed)
+
+    Maps are served from map_cache when the same polylines/colors/maptype/size were rendered
+    before, otherwise they are drawn by the map_renderer backend. Maps google draws when a
+    local render fails are cached under google's key, so the local render is tried again later.
+    '''
+
+    key = _mapKey(poly_list, colors, maptype, m_size)
+    data = map_cache.get(key)
+    if data is not None:
+        return data, key
+
+    if map_renderer == 'local':
+        try:
+            data = await runCompute(strava_render.render_polylines, poly_list, colors=colors,
+                                    m_size=m_size, maptype=maptype, tile_dir=map_tile_dir)
+        except Exception as e:
+            print('Local map render failed ({}), using google static maps'.format(e))
+        if data is None:
+            key = _mapKey(poly_list, colors, maptype, m_size, renderer='google')
+            data = map_cache.get(key)
+            if data is not None:
+                return data, key
+    if data is None:
+        data = await _googleMap(poly_list, colors, maptype, m_size)
+    if data is None:
+        return None, None
+
+    map_cache.put(key, data)
+    return data, key
+
+
+async def _googleMap(poly_list, colors, maptype, m_size):
+    '''Returns the png bytes of a google static map of the given polylines (None if it failed)
+
+    (polylines are simplified to the map's zoom first, full activity polylines can go past the url length limit)
+    '''
+
+    try:
+        poly_list = await runCompute(strava_geometry.simplify_for_map, poly_list, m_size)
+    except Exception as e:
+        print('Could not simplify map polylines ({})'.format(e))
+    if colors is None:
+        paths = ['enc:{}'.format(each) for each in poly_list]
+    else:
+        paths = ['color:{}|weight:2|enc:{}'.format(colors[i], each) for i, each in enumerate(poly_list)]
+
+    url = "https://maps.googleapis.com/maps/api/staticmap?"
+    param = {'size': m_size, 'maptype': maptype, 'path':paths, 'key':g_api_key}
+    map_r = await httpGet(url, params=param)
+    if map_r.status != 200:
+        print('Static map request failed:', map_r.status)
+        return None
+    return map_r.content
+
+
+async def poly_toMap(poly, maptype='roadmap', m_size='640x640'):
+    '''Create a map image from a given polyline (using the map_renderer backend)
     
     Inputs
-        filename : name of file to save map image
-        poly_list : list of all polylines to be plotted on map
+        poly : the polyline of the activity
         maptype (optional) : type of map type (roadmap, satellite, hybrid, terrain)
         m_size (optional) : image size of the map created
+    Returns
+        data : png bytes of the map image (None if the map could not be created)
+        key : map_cache key the image is stored under (None if the map could not be created)
     '''
 
-    url = "https://maps.googleapis.com/maps/api/staticmap?"
-    m_size = '640x640'
-    multipoly = []
+    return await _renderMap([poly], None, maptype, m_size)
 
-    color_list = ['0x0000FF80','0xFF000080','0x00FF0080']
 
-    i = 0
-    for each in poly_list:
-        multipoly.append('color:{}|weight:2|enc:{}'.format(color_list[i], each))
-        i += 1
+async def multiPoly_toMap(poly_list, maptype='roadmap', m_size='640x640'):
+    '''Create a map image from multiple polylines (using the map_renderer backend)
     
-    param = {'size': m_size, 'maptype': maptype, 'path':multipoly, 'key':g_api_key}
-    map_r = requests.get(url, headers=None, params=param)
+    Inputs
+        poly_list : list of all polylines to be plotted on map
+        maptype (optional) : type of map type (roadmap, satellite, hybrid, terrain)
+        m_size (optional) : image size of the map created
+    Returns
+        data : png bytes of the map image (None if the map could not be created)
+        key : map_cache key the image is stored under (None if the map could not be created)
+    '''
 
-    # save map image to /obj/activitymaps with name based on input filename
-    with open('obj/recommendedmaps/{}.png'.format(filename), 'wb') as f:
-        f.write(map_r.content)
-    return map_r
+    color_list = ['0x0000FF80','0xFF000080','0x00FF0080']
 
+    return await _renderMap(poly_list, color_list[:len(poly_list)], maptype, m_size)
 
 
 # ============================================================================ #
@@ -278,23 +1182,75 @@ role_names = {'dist':{80:'Basically a Professional', 50:'UltraMarathoner', 26:'M
               'elev':{13700:'Everest Summiter', 5280:'Mountain Climber'},
               'days':{28:'Might as well join the XC team', 15:'Athlete', 5:'Hobby Runner'}}
 
+sync_concurrency = 8    # max number of users whose activities are fetched at the same time
+sync_max_pages = 10     # max pages of activities requested for one user in a single sync
+deep_sync_interval = 7*86400    # seconds between deep resyncs of a user (picks up edits/deletions)
+deep_sync_window = 35*86400     # how far back (seconds) a deep resync re-fetches activities
+stats_check_interval = 86400    # seconds between full userStats rebuilds of a guild (consistency check)
+
+# userActivities columns used to adjust userStats (see _adjustUserStats)
+_stats_cols = ['activity_id','type','distance','moving_time','elev_gain','day','month','year']
+_stats_checked = {}     # guild_id : time of the last userStats consistency check
+
+route_search_radius = 25    # km from the club center (centroid distance) of routes that can be recommended
+route_bands = [4887, 8045]  # upper distance (m) of the short and medium recommended route bands (long is the rest)
+
+# access tokens (6 hours) are refreshed at a random time between token_refresh_margin and
+# token_refresh_margin + token_refresh_jitter seconds before they expire
+# (strava only issues a new token within an hour of expiry)
+token_refresh_margin = 1800
+token_refresh_jitter = 1200
+token_refresh_spacing = 0.5     # min seconds between refreshes started by the scheduler (spreads out overdue ones)
+token_retry_base = 30           # seconds before the first retry of a failed refresh (doubles on every failure)
+token_retry_max = 3600          # max seconds between retries of a failed refresh
+
+# guild jobs run every <freq> hours (guildSettings *_freq, on the hours divisible by freq)
+# job : (frequency column, channel column) in guildSettings
+guild_jobs = {'update': ('update_freq', None),
+              'rec': ('rec_freq', 'rec_id'),
+              'show': ('show_freq', 'show_id'),
+              'lead': ('lead_freq', 'lead_id')}
+schedule_jitter = 600   # max seconds a guild job is delayed past its hour (spreads guilds' api calls apart)
+
+embed_prerender_days = 2    # activities from the last N days get their embed and map rendered when stored
+
+# leaderboard reaction : sort
+leaderboard_reactions = {'📏':'dist', '⌚':'time', '🪜':'elev', '🗓':'days'}
+leaderboard_message_ttl = 35*86400  # seconds a posted leaderboard keeps reacting to sort changes
+
+# strava push subscription (webhook) receiver, off unless enabled with a verify token and the subscription id
+# (while it is running, the looping sync only fetches users that are due a deep resync)
+webhook_enabled = os.environ.get('STRAVA_WEBHOOK_ENABLED', '0') == '1'
+webhook_host = os.environ.get('STRAVA_WEBHOOK_HOST', '0.0.0.0')
+webhook_port = int(os.environ.get('STRAVA_WEBHOOK_PORT', 8080))
+webhook_path = '/strava/webhook'
+webhook_verify_token = os.environ.get('STRAVA_WEBHOOK_VERIFY_TOKEN')
+webhook_subscription_id = os.environ.get('STRAVA_WEBHOOK_SUBSCRIPTION_ID')
+
 
 # ============================================================================ #
 # |||||||||||||||||||||||          Load Data           ||||||||||||||||||||||| #
 # ============================================================================ #
 
-# loads variables bot_token, client_secret, g_api_key, client_id, bot_id
-with open('obj/botInfo.txt') as f:
-    bot_token, client_secret, g_api_key, \
-           client_id, bot_id = f.read().splitlines()
-print('Bot Token:______'+bot_token)
-print('Client Secret:__'+client_secret)
-print('Google API Key:_'+g_api_key)
-print('Client ID:______'+client_id)
-print('Bot ID:_________'+bot_id)
+# bot_token, client_secret, g_api_key, client_id, bot_id (set by loadBotInfo)
+bot_token = client_secret = g_api_key = client_id = bot_id = None
+
 
-bot_id = int(bot_id)
-client_id = int(client_id)
+def loadBotInfo(path='obj/botInfo.txt'):
+    '''Loads variables bot_token, client_secret, g_api_key, client_id, bot_id'''
+
+    global bot_token, client_secret, g_api_key, client_id, bot_id
+    with open(path) as f:
+        bot_token, client_secret, g_api_key, \
+               client_id, bot_id = f.read().splitlines()
+    print('Bot Token:______'+bot_token)
+    print('Client Secret:__'+client_secret)
+    print('Google API Key:_'+g_api_key)
+    print('Client ID:______'+client_id)
+    print('Bot ID:_________'+bot_id)
+
+    bot_id = int(bot_id)
+    client_id = int(client_id)
 
 # use this to set permissions (in front of command definition, but after client.command decorator) : @commands.has_role("Admin")
 
@@ -311,179 +1267,457 @@ client = commands.Bot(command_prefix = '$strava ',help_command=None)
 # ||||||        Discord Helper Functions        |||||| #
 # ==================================================== #
 
-def _removeExpiredTokens():
-    '''Delete rows of database table where access tokens have expired'''
+def _activityRow(discord_id, each):
+    '''Convert a strava activity (json dict) into a userActivities row (dict)'''
 
-    print('Removed Tokens:',len(dataRead('userTokens', ['*'], cond_key='exp_at', cond_ineq='<', cond_value=time.time())))
-    dataDelete('userTokens', cond_key='exp_at', cond_ineq='<', cond_value=time.time())
+    start_date = each['start_date_local'].split('T')[0].split('-')
+    return {'discord_id' : discord_id,
+            'activity_id': each['id'],
+            'activity_name': each['name'],
+            'distance': each['distance'],
+            'moving_time': each['moving_time'],
+            'elev_gain': each['total_elevation_gain'],
+            'type': each['type'],
+            'start_date_local': each['start_date_local'],
+            'geometry': strava_geometry.pack_polyline(each['map']['summary_polyline']),
+            'day': int(start_date[2]),
+            'month': int(start_date[1]),
+            'year': int(start_date[0])}
 
 
-def _updateAccessTokens():
-    '''Updates the access tokens (userTokens table) for authorized users 
-    and updates the database'''
+def _startEpoch(activity):
+    '''Returns the (UTC) start time of a strava activity (json dict) in epoch seconds'''
+    start = datetime.datetime.strptime(activity['start_date'], '%Y-%m-%dT%H:%M:%SZ')
+    return start.replace(tzinfo=datetime.timezone.utc).timestamp()
 
-    token_url = 'https://www.strava.com/oauth/token'
-    
-    # get all user tokens to be updated (all tokens)
-    tokenList = dataRead('userTokens', ['*'])
-    
-    if len(tokenList) > 0:
-        for i in tokenList:
-            discord_id = tokenList[i][0]
-            ref_token = tokenList[i][2]
-            ac_token = tokenList[i][3]
-
-            refreshToken_payload = {'client_id' : client_id,
-                                    'client_secret' : client_secret,
-                                    'refresh_token' : ref_token,
-                                    'grant_type' : 'refresh_token',
-                                    'f' : 'json'}
-            # make request to strava api to update access tokens (returns new access and refresh tokens)
-            res = requests.post(token_url, data=refreshToken_payload, verify=False).json()
-
-            access_token = res['access_token']
-            refresh_token = res['refresh_token']
-            exp_at = res['expires_at']
-
-            # update the new token values in the database (for each user (discord_id))
-            dataUpdate('userTokens', ['ref_token','ac_token','exp_at'],
-                       [refresh_token, access_token, exp_at],
-                       cond_key='discord_id', cond_ineq='=', cond_value=discord_id)
-    else:
-        # if length of tokenList is 0 (no authorized users)
-        print('No Authorized Users')
 
+async def _fetchActivityPages(discord_id, header, param, num_activities, priority):
+    '''Fetch pages of a user's activities until a short page (or sync_max_pages) is reached
+
+    Returns
+        activities : list of strava activities (json dicts), or None if a request failed
+        complete : False if sync_max_pages was reached (there may be more activities)
+    '''
+
+    ua_url = 'https://www.strava.com/api/v3/athlete/activities'
+    activities = []
+    for page in range(1, sync_max_pages+1):
+        param['page'] = page
+        res = await httpGet(ua_url, headers=header, params=param, priority=priority)
+        if res.status != 200:
+            print('Could not fetch activities for user: {} (status {})'.format(discord_id, res.status))
+            return None, False
+        page_activities = res.json()
+        activities += page_activities
+        if len(page_activities) < num_activities:
+            return activities, True
+    return activities, False
+
+
+async def _syncUserActivities(discord_id, num_activities, semaphore, priority=PRIORITY_BACKGROUND, deep=False, poll=True):
+    '''Fetch a single user's new activities and write them to userActivities in one batch
+
+    Only activities that started after the user's cursor (syncCursors.last_start) are requested.
+    A user with no cursor gets their latest num_activities. Every deep_sync_interval (or when
+    deep=True) the last deep_sync_window of activities is re-fetched instead, so edits are
+    re-written and activities deleted on strava are removed.
 
-def _updateUserActivities(guild_id, num_activities=99):
-    '''Update user activities and save new activities to userActivities table in database
-    
     Inputs
-        guild_id : (server_id) id number for the server where userActivities will be updated
+        discord_id : discord identifying number of the user to sync
+        num_activities : the maxiumum number of activities to fetch per request
+        semaphore : (type:asyncio.Semaphore) bounds the number of users fetched at the same time
+        priority (optional) : strava quota priority of the request (PRIORITY_INTERACTIVE/PRIORITY_BACKGROUND)
+        deep (optional) : force a deep resync for this user
+        poll (optional) : if False, only sync the user when they are due a deep resync (or have no cursor)
+    Returns
+        count : number of activities written for the user
+    '''
+
+    now = time.time()
+    cursor = dataRead('syncCursors', ['last_start','last_deep'],
+                      cond_key='discord_id', cond_ineq='=', cond_value=discord_id, fetchOne=True)
+    if cursor is not None and not poll and not deep and now - cursor[1] < deep_sync_interval:
+        return 0
+
+    async with semaphore:
+        ac_token = await _accessToken(discord_id, priority)
+        if ac_token is None:
+            return 0
+        header = {'Authorization': 'Bearer ' + ac_token}
+        if cursor is None:
+            # first sync for this user (latest activities only)
+            res = await httpGet('https://www.strava.com/api/v3/athlete/activities', headers=header,
+                                params={'per_page': num_activities, 'page':1}, priority=priority)
+            if res.status != 200:
+                print('Could not fetch activities for user: {} (status {})'.format(discord_id, res.status))
+                return 0
+            activities = res.json()
+            complete = True
+            last_start, last_deep = 0, now
+        else:
+            last_start, last_deep = cursor
+            deep = deep or now - last_deep >= deep_sync_interval
+            after = now - deep_sync_window if deep else last_start
+            activities, complete = await _fetchActivityPages(discord_id, header,
+                                                   {'per_page': num_activities, 'after': int(after)},
+                                                   num_activities, priority)
+            if activities is None:
+                return 0
+            if deep:
+                last_deep = now
+
+    with transaction():
+        rows = [_activityRow(discord_id, each) for each in activities]
+        _storeActivities(discord_id, rows)
+        if len(activities) > 0 and 'athlete' in activities[0]:
+            # keep the strava athlete id (used to match webhook events to users)
+            dataUpdate('_idTable', ['strava_id'], [activities[0]['athlete']['id']],
+                       cond_key='discord_id', cond_ineq='=', cond_value=discord_id, extra_cond=[('strava_id', 'IS', None)])
+
+        if cursor is not None and deep and not complete:
+            print('sync_max_pages reached for user {}, not checking for deleted activities'.format(discord_id))
+        elif cursor is not None and deep:
+            # remove activities (inside the window) that no longer exist on strava
+            # (local dates are compared a day inside the window to allow for timezone offsets)
+            window_start = datetime.datetime.fromtimestamp(now - deep_sync_window + 86400, datetime.timezone.utc).strftime('%Y-%m-%d')
+            kept_ids = set(each['activity_id'] for each in rows)
+            local_ids = dataRead('userActivities', ['activity_id'],
+                                 cond_key='discord_id', cond_ineq='=', cond_value=discord_id,
+                                 extra_cond=[('start_date_local', '>=', window_start)])
+            deleted_ids = [each[0] for each in local_ids if each[0] not in kept_ids]
+            _deleteActivities(discord_id, deleted_ids)
+            if len(deleted_ids) > 0:
+                print('removed deleted activities:', deleted_ids)
+
+        if len(activities) > 0:
+            last_start = max(last_start, max(_startEpoch(each) for each in activities))
+        dataEntry('syncCursors', {'discord_id':discord_id, 'last_start':last_start, 'last_deep':last_deep})
+    return len(rows)
+
+
+# users are synced once for every guild they are in (guild jobs share the result)
+_synced_at = {}         # discord_id : time the user's last sync finished
+_syncing = {}           # discord_id : future of the user's sync in flight
+_sync_semaphore = None  # (type:asyncio.Semaphore) bounds the users fetched at the same time (across all callers)
+
+
+def _guildMembers(guild_id):
+    '''Returns the discord_id(s) of the authorized users in a guild'''
+    return [x[0] for x in dataRead('_idTable', ['discord_id'], cond_key='guild_id', cond_ineq='=', cond_value=guild_id)]
+
+
+async def _syncUser(discord_id, num_activities, priority, deep, poll):
+    '''Sync a single user (see _syncUserActivities) and record when it finished'''
+
+    global _sync_semaphore
+    if _sync_semaphore is None:
+        _sync_semaphore = asyncio.Semaphore(sync_concurrency)
+    count = await _syncUserActivities(discord_id, num_activities, _sync_semaphore, priority, deep, poll)
+    _synced_at[discord_id] = time.time()
+    return count
+
+
+async def _ensureSynced(discord_ids=None, max_age=0, num_activities=99, priority=PRIORITY_BACKGROUND, deep=False, poll=True):
+    '''Make sure users' activities are synced, fetching each user at most once for all callers
+
+    Users synced less than max_age seconds ago are skipped, and users whose sync is already in
+    flight (ex: for another guild) are waited on instead of being fetched again. At most
+    sync_concurrency users are fetched at the same time.
+
+    Inputs
+        discord_ids (optional) : users to sync (default: every authorized user)
+        max_age (optional) : seconds a previous sync of a user stays fresh
         num_activities (optional) : the maxiumum number of activities to add at one time
+        priority (optional) : strava quota priority of the requests (PRIORITY_INTERACTIVE/PRIORITY_BACKGROUND)
+        deep (optional) : force a deep resync (re-fetch recent activities) for every user
+        poll (optional) : if False, only sync users that are due a deep resync (webhooks keep the rest current)
     '''
 
     print('attempting to update activities. . .')
-    tokenList = dataRead('userTokens', ['*'])
-
-    if len(tokenList) > 0:
-        for i in range(len(tokenList)):
-            discord_id = tokenList[i][0]
-            ac_token = tokenList[i][3]
-
-            ua_url = 'https://www.strava.com/api/v3/athlete/activities'
-            header = {'Authorization': 'Bearer ' + ac_token}
-            param = {'per_page': num_activities, 'page':1}
-            
-            activities = requests.get(ua_url, headers=header, params=param).json()
-
-            for each in activities:
-                activity = {'discord_id' : discord_id,
-                            'activity_id': each['id'],
-                            'activity_name': each['name'],
-                            'distance': each['distance'],
-                            'moving_time': each['moving_time'],
-                            'elev_gain': each['total_elevation_gain'],
-                            'type': each['type'],
-                            'start_date_local': each['start_date_local'],
-                            'polyline': each['map']['summary_polyline'],
-                            'day': int(each['start_date_local'].split('T')[0].split('-')[2]),
-                            'month': int(each['start_date_local'].split('T')[0].split('-')[1]),
-                            'year': int(each['start_date_local'].split('T')[0].split('-')[0])}
-                
-                dataEntry('userActivities', activity)
+    tokens = _userTokens()
+    discord_ids = list(tokens) if discord_ids is None else [int(x) for x in discord_ids if int(x) in tokens]
+    now = time.time()
+
+    futures = {}
+    for discord_id in discord_ids:
+        if discord_id in _syncing:
+            futures[discord_id] = _syncing[discord_id]
+        elif now - _synced_at.get(discord_id, 0) >= max_age:
+            future = asyncio.ensure_future(_syncUser(discord_id, num_activities, priority, deep, poll))
+            future.add_done_callback(lambda f, x=discord_id: _syncing.pop(x, None))
+            _syncing[discord_id] = futures[discord_id] = future
+
+    results = await asyncio.gather(*[asyncio.shield(x) for x in futures.values()], return_exceptions=True)
+    for discord_id, result in zip(futures, results):
+        if isinstance(result, Exception):
+            print('Error updating activities for user: {} ({})'.format(discord_id, result))
+
+
+def _guildTypes(guild_id):
+    '''Returns the guild's activity types as a list (ex: ['Run','Walk']), or None if not set'''
+
+    settings = _guildSettings(guild_id)
+    if settings is None or len(settings.types) <= 0:
+        return None
+    return sorted(settings.types)
+
+
+def _insertMonthlyStats(guild_id, types, month, year, discord_id=None):
+    '''Total the monthly activities (of the guild's types) of the guild's users into userStats rows
+
+    Totals are computed in sqlite with one grouped SUM/COUNT(DISTINCT day) statement
+    (existing userStats rows must be deleted first)
+
+    Inputs
+        guild_id : (server_id) id number for the server of the userStats rows
+        types : list of the guild's activity types (see _guildTypes)
+        month, year : month and year to total
+        discord_id (optional) : only total this user (instead of every user in the guild)
+    '''
+
+    type_sql, type_params = _sqlCondition('type', 'IN', types)
+    if discord_id == None:
+        user_sql, user_params = 'discord_id IN (SELECT discord_id FROM _idTable WHERE guild_id = ?)', [guild_id]
+    else:
+        user_sql, user_params = 'discord_id = ?', [discord_id]
+
+    c.execute('INSERT INTO userStats (discord_id, dist, time, elev, days, day_mask, guild_id) '
+              'SELECT discord_id, SUM(distance), SUM(moving_time), SUM(elev_gain), COUNT(DISTINCT day), '
+              'SUM(DISTINCT 1 << day), ? '
+              'FROM userActivities '
+              'WHERE month = ? AND year = ? AND {} AND {} '
+              'GROUP BY discord_id'.format(type_sql, user_sql),
+              [guild_id, month, year] + type_params + user_params)
+    _commit()
 
 
 def _updateUserStats(guild_id):
-    '''Go through user activities and update userStats based on monthly totals'''
+    '''Go through user activities and rebuild userStats based on monthly totals
 
-    today = datetime.date.today().strftime("%Y-%m-%d")
-    month = today.split('-')[1]
-    year = today.split('-')[0]
+    (userStats is kept up to date by _adjustUserStats as activities change, a full
+     rebuild is only needed as a consistency check, see _checkUserStats)
+    '''
 
-    discord_id_list = dataRead('_idTable',
-                                ['discord_id'],
-                                cond_key='guild_id', cond_ineq='=', cond_value=guild_id)
-    try:
+    today = datetime.date.today()
+    types = _guildTypes(guild_id)
+
+    _invalidateLeaderboard(guild_id)
+    with transaction():
         dataDelete('userStats', cond_key='guild_id', cond_ineq='=', cond_value=guild_id)
-    except:
-        print('could not delete userStats')
-    type_list = dataRead('guildSettings',['types'],
-                            cond_key='guild_id', cond_ineq='=', cond_value=guild_id)
-    if len(type_list) > 0:
-        print(type_list[0])
-        if len(type_list[0]) > 0:
-            type_string = ""
-            print(type_list[0][0])
-            if len(type_list[0][0]) > 0:
-                for each in type_list[0][0].split(','):
-                    if len(type_string) == 0:
-                        type_string += "\'{}\'".format(each)
-                    else:
-                        type_string += ",\'{}\'".format(each)
-                if len(discord_id_list) > 0:
-                    for each in discord_id_list:
-                        discord_id = each[0]
-
-                        monthly_activities = dataRead('userActivities',
-                                                      ['activity_id','distance','moving_time','elev_gain',
-                                                       'type','start_date_local'],
-                                                      cond_key='discord_id', cond_ineq='=', cond_value=discord_id,
-                                                      extra_cond='month = {} AND year = {} AND type IN ({})'.format(month, year, type_string))
-                        print(type_string)
-                        if len(monthly_activities) > 0:
-                            dist_total = 0
-                            time_total = 0
-                            elev_total = 0
-                            days_set = set()
-                            for activity in monthly_activities:
-                                dist_total += activity[1]
-                                time_total += activity[2]
-                                elev_total += activity[3]
-                                days_set.add(activity[5].split('T')[0].split('-')[2])
-                            days_total = len(days_set)
-
-                            stats_dict = {'discord_id':discord_id, 'guild_id': guild_id,
-                                          'dist':dist_total, 'time':time_total,'elev':elev_total,'days':days_total}
-                            dataEntry('userStats',stats_dict)
-                        else:
-                            print('no monthly activities')
-                else:
-                    print('no authorized users in guild:',guild_id)
-            else:
-                print('No valid activity types. (Must set guild valid activity types using addType command)')
+        if types != None:
+            _insertMonthlyStats(guild_id, types, today.month, today.year)
+        else:
+            print('No valid activity types. (Must set guild valid activity types using addType command)')
 
 
-def _updateDailyActivities(guild_id):
-    '''Go through user activities and add all today's activities to dailyActivities Table'''
+def _checkUserStats(guild_id):
+    '''Occasional consistency check of a guild's userStats (at most once every stats_check_interval)
 
-    today = datetime.date.today().strftime("%Y-%m-%d")
-    day = today.split('-')[2]
-    month = today.split('-')[1]
-    year = today.split('-')[0]
+    Rebuilds the guild's userStats from userActivities and reports any rows that had drifted
+    '''
 
-    discord_id_list = dataRead('_idTable',
-                                ['discord_id'],
-                                cond_key='guild_id', cond_ineq='=', cond_value=guild_id)
-    if len(discord_id_list) <= 0:
+    if time.time() - _stats_checked.get(guild_id, 0) < stats_check_interval:
         return
-    discord_id_list = ','.join([str(x[0]) for x in discord_id_list])
-
-    daily_activities = dataRead('userActivities',
-                                ['discord_id','activity_id','activity_name','distance',
-                                 'moving_time','elev_gain','type','day','month','year'],
-                                cond_key='day', cond_ineq='=', cond_value=day,
-                                extra_cond='month = {} AND year = {} and discord_id IN ({})'.format(month, year, discord_id_list))
-    if len(daily_activities) > 0:
-        for each in daily_activities:
-            dailyActivity = {'discord_id' : each[0],
-                             'activity_id' : each[1],
-                             'activity_name' : each[2],
-                             'distance' : each[3],
-                             'moving_time' :  each[4],
-                             'elev_gain' : each[5],
-                             'type' : each[6],
-                             'guild_id' : guild_id}
-            dataEntry('dailyActivities', dailyActivity)
+    cols = ['discord_id','ROUND(dist, 3)','ROUND(time, 3)','ROUND(elev, 3)','days']
+    before = set(dataRead('userStats', cols, cond_key='guild_id', cond_ineq='=', cond_value=guild_id))
+    _updateUserStats(guild_id)
+    after = set(dataRead('userStats', cols, cond_key='guild_id', cond_ineq='=', cond_value=guild_id))
+    _stats_checked[guild_id] = time.time()
+
+    if before != after:
+        print('userStats drift corrected for guild {} ({} rows)'.format(guild_id, len(set(x[0] for x in before ^ after))))
+
+
+def _adjustUserStats(discord_id, changes):
+    '''Apply the difference of changed activities to a user's userStats rows (in every guild they are in)
+
+    Only activities from the current month (and of the guild's types) count. Each row keeps a
+    bitmap of active days (day_mask) so days stays exact: a day is only cleared once the user has
+    no other counted activity on that day. Must be called after the activities are written/deleted.
+
+    Inputs
+        discord_id : discord identifying number of the user
+        changes : list of (old, new) userActivities rows (dicts with at least the _stats_cols keys,
+                  old is None for a new activity and new is None for a deleted activity)
+    '''
+
+    today = datetime.date.today()
+    guild_ids = set(x[0] for x in dataRead('_idTable', ['guild_id'], cond_key='discord_id', cond_ineq='=', cond_value=discord_id))
+
+    with transaction():
+        for guild_id in guild_ids:
+            types = _guildTypes(guild_id)
+            if types == None:
+                continue
+
+            def counted(row):
+                return row != None and row['type'] in types and row['month'] == today.month and row['year'] == today.year
+
+            delta = [0, 0, 0]
+            added_days, removed_days = set(), set()
+            for old, new in changes:
+                for row, sign, days in [(old, -1, removed_days), (new, 1, added_days)]:
+                    if counted(row):
+                        delta[0] += sign * row['distance']
+                        delta[1] += sign * row['moving_time']
+                        delta[2] += sign * row['elev_gain']
+                        days.add(row['day'])
+            if len(added_days) <= 0 and len(removed_days) <= 0:
+                continue
+
+            stats = dataRead('userStats', ['dist','time','elev','day_mask'],
+                             cond_key='discord_id', cond_ineq='=', cond_value=discord_id,
+                             extra_cond=[('guild_id', '=', guild_id)], fetchOne=True)
+            if stats == None:
+                stats = (0, 0, 0, 0)
+            day_mask = stats[3] or 0
+            for day in added_days:
+                day_mask |= 1 << day
+            for day in removed_days - added_days:
+                remaining = dataRead('userActivities', ['activity_id'],
+                                     cond_key='discord_id', cond_ineq='=', cond_value=discord_id,
+                                     extra_cond=[('year', '=', today.year), ('month', '=', today.month),
+                                                 ('type', 'IN', types), ('day', '=', day)], fetchOne=True)
+                if remaining == None:
+                    day_mask &= ~(1 << day)
+
+            _invalidateLeaderboard(guild_id)
+            dataEntry('userStats', {'discord_id':discord_id, 'guild_id':guild_id,
+                                    'dist':stats[0]+delta[0], 'time':stats[1]+delta[1], 'elev':stats[2]+delta[2],
+                                    'days':bin(day_mask).count('1'), 'day_mask':day_mask})
+
+
+def _readActivities(activity_ids, cols=_stats_cols):
+    '''Returns the stored userActivities rows (cols, default _stats_cols) of the given ids as {activity_id: row dict}'''
+
+    rows = dataRead('userActivities', cols, cond_key='activity_id', cond_ineq='IN', cond_value=list(activity_ids))
+    return {row[cols.index('activity_id')]: dict(zip(cols, row)) for row in rows}
+
+
+def _storeActivities(discord_id, rows):
+    '''Upsert a user's userActivities rows and apply the changes to their userStats (one transaction)
+
+    Rows identical to the stored ones (ex: a resync) are not written again, and keep their
+    pre-rendered embed
+    '''
+
+    if len(rows) <= 0:
+        return
+    with transaction():
+        old_rows = _readActivities([each['activity_id'] for each in rows], cols=list(rows[0]))
+        changed = [each for each in rows if old_rows.get(each['activity_id']) != each]
+        dataEntryMany('userActivities', changed)
+        dataDelete('activityEmbeds', cond_key='activity_id', cond_ineq='IN', cond_value=[each['activity_id'] for each in changed])
+        _adjustUserStats(discord_id, [(old_rows.get(each['activity_id']), each) for each in changed])
+        _queueShowcase(discord_id, rows)
+    _queueEmbeds(changed)
+
+
+def _deleteActivities(discord_id, activity_ids):
+    '''Delete a user's activities (userActivities and dailyActivities) and remove them from their userStats'''
+
+    if len(activity_ids) <= 0:
+        return
+    with transaction():
+        old_rows = _readActivities(activity_ids)
+        dataDelete('userActivities', cond_key='activity_id', cond_ineq='IN', cond_value=list(activity_ids))
+        dataDelete('dailyActivities', cond_key='activity_id', cond_ineq='IN', cond_value=list(activity_ids))
+        dataDelete('activityEmbeds', cond_key='activity_id', cond_ineq='IN', cond_value=list(activity_ids))
+        _adjustUserStats(discord_id, [(old_rows[x], None) for x in old_rows])
+
+
+# guild_id : activity_ids of the guild's current day (in its time zone) that haven't been showcased
+# (loaded from dailyActivities on first use, activities are added as they are stored)
+_showcase_queues = {}
+
+
+def _guildNow(guild_id):
+    '''Returns the current time in a guild's time zone (the bot's local time if it has none)'''
+
+    settings = _guildSettings(guild_id)
+    if settings is not None and settings.tz is not None and ZoneInfo is not None:
+        try:
+            return datetime.datetime.now(ZoneInfo(settings.tz))
+        except Exception:
+            pass
+    return datetime.datetime.now()
+
+
+def _guildMidnight(guild_id):
+    '''Returns the time (epoch seconds) of the next midnight in a guild's time zone'''
+
+    now = _guildNow(guild_id)
+    midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time(), tzinfo=now.tzinfo)
+    return midnight.timestamp()
+
+
+def _showcaseQueue(guild_id):
+    '''Returns the showcase queue of a guild (list of activity_ids, loaded from dailyActivities on first use)'''
+
+    if guild_id not in _showcase_queues:
+        rows = dataRead('dailyActivities', ['activity_id'], cond_key='guild_id', cond_ineq='=', cond_value=guild_id,
+                        extra_cond=[('local_date', '=', _guildNow(guild_id).date().isoformat()), ('showcased', '=', 0)])
+        _showcase_queues[guild_id] = [x[0] for x in rows]
+    return _showcase_queues[guild_id]
+
+
+def _queueShowcase(discord_id, rows):
+    '''Add newly stored activities to the showcase queue of each of the user's guilds
+
+    Activities from before a guild's current day are skipped (and ones already queued keep their
+    showcased flag). Only guilds with settings are queued, since their queues are rolled over daily.
+
+    Inputs
+        discord_id : discord identifying number of the user
+        rows : userActivities rows (dicts)
+    '''
+
+    guild_ids = set(x[0] for x in dataRead('_idTable', ['guild_id'], cond_key='discord_id', cond_ineq='=', cond_value=discord_id))
+    with transaction():
+        for guild_id in guild_ids:
+            if _guildSettings(guild_id) is None:
+                continue
+            today = _guildNow(guild_id).date().isoformat()
+            for each in rows:
+                local_date = '{:04d}-{:02d}-{:02d}'.format(each['year'], each['month'], each['day'])
+                if local_date < today:
+                    continue
+                c.execute('INSERT OR IGNORE INTO dailyActivities (guild_id, activity_id, discord_id, local_date) VALUES (?,?,?,?)',
+                          (guild_id, each['activity_id'], discord_id, local_date))
+                if c.rowcount == 1 and local_date == today and guild_id in _showcase_queues:
+                    _showcase_queues[guild_id].append(each['activity_id'])
+
+
+def _popShowcase(guild_id):
+    '''Take a random activity from a guild's showcase queue and mark it as showcased
+
+    Returns
+        activity_id : the activity to showcase (None if there are no activities left today)
+    '''
+
+    queue = _showcaseQueue(guild_id)
+    while len(queue) > 0:
+        # swap a random entry to the end so it can be popped in O(1)
+        i = random.randrange(len(queue))
+        queue[i], queue[-1] = queue[-1], queue[i]
+        activity_id = queue.pop()
+        c.execute('UPDATE dailyActivities SET showcased = 1 WHERE guild_id = ? AND activity_id = ? AND showcased = 0',
+                  (guild_id, activity_id))
+        updated = c.rowcount
+        _commit()
+        if updated == 1:
+            return activity_id
+        # (the activity was deleted since it was queued)
+    return None
+
+
+def _rolloverShowcase(guild_id):
+    '''Start a guild's new day: drop its showcase activities from previous days and reload its queue'''
+
+    today = _guildNow(guild_id).date().isoformat()
+    dataDelete('dailyActivities', cond_key='guild_id', cond_ineq='=', cond_value=guild_id,
+               extra_cond=[('local_date', '<', today)])
+    _showcase_queues.pop(guild_id, None)
 
 
 async def _createActivity(activity_id, pfp, username, maptype='roadmap'):
@@ -498,30 +1732,22 @@ async def _createActivity(activity_id, pfp, username, maptype='roadmap'):
         maptype (optional) : design of map (options include roadmap, terrain, hybrid)
     Returns
         embed : the activity embed displayed through discord (includes title, description, and map)
-        im_file : the file location for the embeded activity map
+        im_file : the embeded activity map (None if the activity has no map)
+        map_key : map_cache key of the map (None if the activity has no map)
     '''
 
     activity = dataRead('userActivities', ['activity_name','distance','moving_time','elev_gain',
-                                           'type','start_date_local','polyline'],
+                                           'type','start_date_local','geometry'],
                         cond_key='activity_id', cond_ineq='=', cond_value=activity_id)
     if len(activity) <= 0:
         print('No activities with this id')
         return None
-    map_im = poly_toMap(activity_id, poly=activity[0][6], maptype=maptype)
+    map_data = map_key = None
+    if activity[0][6]:
+        map_data, map_key = await poly_toMap(strava_geometry.unpack_polyline(activity[0][6]), maptype=maptype)
 
-    start_date = activity[0][5].split('T')[0].split('-')
-    start_time = activity[0][5].split('T')[1].split(':')
-
-    if int(start_time[0]) >= 12:
-        am_pm = 'PM'
-    else:
-        am_pm = 'AM'
-    if int(start_time[0]) % 12 == 0:
-        hour = 12
-    else:
-        hour = int(start_time[0]) % 12
-    desc_time = '{}/{}/{} at {}:{} {}'.format(start_date[1], start_date[2], start_date[0],
-                                              hour, start_time[1], am_pm)
+    start = datetime.datetime.strptime(activity[0][5], '%Y-%m-%dT%H:%M:%SZ')
+    desc_time = '{:%m/%d/%Y} at {}:{:%M %p}'.format(start, start.hour % 12 or 12, start)
     embed = discord.Embed(title=activity[0][0],
                           description=desc_time,
                           color=0x00ff00)
@@ -536,14 +1762,35 @@ async def _createActivity(activity_id, pfp, username, maptype='roadmap'):
     embed.add_field(name="Time", value=str(time), inline=True)
     embed.add_field(name="Elev Gain", value=str(elev_gain)+' ft', inline=True)
 
-    im_file = discord.File('obj/activitymaps/{}_{}.png'.format(activity_id, maptype))
-    embed.set_image(url='attachment://obj/activitymaps/{}_{}.png'.format(activity_id, maptype))
+    im_file = None
+    if map_data is not None:
+        im_file = discord.File(io.BytesIO(map_data), filename='map.png')
+        embed.set_image(url='attachment://map.png')
 
-    return embed, im_file
+    return embed, im_file, map_key
+
+
+# guild_id : {sort : embed} leaderboards of all four sorts, built from the guild's current userStats
+_leaderboard_snapshots = {}
+_leaderboard_version = 0    # incremented by every invalidation (a snapshot built across one is not kept)
+
+
+def _invalidateLeaderboard(guild_id=None):
+    '''Drop the leaderboard snapshot of a guild (every guild if None) after its userStats/users change'''
+
+    global _leaderboard_version
+    _leaderboard_version += 1
+    if guild_id is None:
+        _leaderboard_snapshots.clear()
+    else:
+        _leaderboard_snapshots.pop(guild_id, None)
 
 
-def _createLeaderboard(guild_id, sort='dist'):
+async def _createLeaderboard(guild_id, sort='dist'):
     '''Creates a leaderboard from the userStats of users in specified guild
+
+    The leaderboards of all four sorts are built at once and kept as a snapshot until the
+    guild's userStats change (see _invalidateLeaderboard), so switching sorts needs no queries
     
     Inputs
         guild_id : (server_id) id number for the server where leaderboard will be posted
@@ -551,10 +1798,31 @@ def _createLeaderboard(guild_id, sort='dist'):
     Returns
         embed_update : a embed for the guild/club leaderboard
     '''
-    
-    embed_update = discord.Embed(title='Activities Leaderboard',
-                                description=datetime.datetime.now().strftime('%B')+' '+str(datetime.datetime.now().year),
-                                color=0x00ff00)
+
+    if sort not in strava_render.leaderboard_stats:
+        raise ValueError('Bad sort input')
+
+    snapshot = _leaderboard_snapshots.get(guild_id)
+    if snapshot is None:
+        version = _leaderboard_version
+        snapshot = await _buildLeaderboards(guild_id)
+        if snapshot is None:
+            return None
+        if version == _leaderboard_version:
+            _leaderboard_snapshots[guild_id] = snapshot
+    return snapshot[sort]
+
+
+async def _buildLeaderboards(guild_id):
+    '''Builds the leaderboard embeds of a guild for every sort
+
+    The leaderboard text of large guilds is built in the compute pool
+
+    Inputs
+        guild_id : (server_id) id number for the server where leaderboard will be posted
+    Returns
+        embeds : dictionary of sort : leaderboard embed (None if there is no user data)
+    '''
 
     # get discord_id(s) of all authorized users in the guild
     discord_ids = dataRead('_idTable', ['discord_id'], cond_key='guild_id', cond_ineq='=', cond_value=guild_id)
@@ -562,14 +1830,13 @@ def _createLeaderboard(guild_id, sort='dist'):
     if len(discord_ids) <= 0:
         print('No User Data (no authorized users in _idTable)')
         return
-    discord_ids = [str(val[0]) for val in discord_ids]
-    discord_ids = ', '.join(discord_ids)
+    discord_ids = [val[0] for val in discord_ids]
 
     # get the user stats for all the discord_id(s)
     user_data = dataRead('userStats',
                          ['discord_id','dist','time','elev','days'],
-                         cond_key='discord_id', cond_ineq='IN', cond_value='({})'.format(discord_ids),
-                         extra_cond='guild_id = {}'.format(guild_id))
+                         cond_key='discord_id', cond_ineq='IN', cond_value=discord_ids,
+                         extra_cond=[('guild_id', '=', guild_id)])
     if len(user_data) <= 0:
         print('No User Data (userStats not found for authorized users)')
         return
@@ -581,101 +1848,115 @@ def _createLeaderboard(guild_id, sort='dist'):
         return
 
     # create a discord_id:username (key:value) dictionary
-    username_dict = {}
-    for i in range(len(discord_usernames)):
-        username_dict[str(discord_usernames[i][0])] = discord_usernames[i][1]
-
-    #sort the user data for the leaderboard by one of the sort methods
-    if sort == 'dist':
-        sorted_data = sorted(user_data, key=lambda x: x[1], reverse=True)
-    elif sort == 'time':
-        sorted_data = sorted(user_data, key=lambda x: x[2], reverse=True)
-    elif sort == 'elev':
-        sorted_data = sorted(user_data, key=lambda x: x[3], reverse=True)
-    elif sort == 'days':
-        sorted_data = sorted(user_data, key=lambda x: x[4], reverse=True)
+    username_dict = {each[0]: each[1] for each in discord_usernames}
+
+    # sort the user data and build the text of the rank, name, and stat columns of every sort
+    if len(user_data) >= compute_offload_rows:
+        columns = await runCompute(strava_render.leaderboard_columns, user_data, username_dict)
     else:
-        raise ValueError('Bad sort input')
+        columns = strava_render.leaderboard_columns(user_data, username_dict)
 
-    # initialize the leadreboard text for each of the fields
-    rank, name, dist, time, elev, days = '', '', '', '', '', ''
-    iter_val = 0
+    now = datetime.datetime.now()
+    embeds = {}
+    for sort in columns:
+        embeds[sort] = discord.Embed(title='Activities Leaderboard',
+                                     description=now.strftime('%B')+' '+str(now.year),
+                                     color=0x00ff00)
+        for name, value in columns[sort]:
+            embeds[sort].add_field(name=name, value=value, inline=True)
+    return embeds
 
-    for each in sorted_data:
-        iter_val += 1
-        rank += '#{}'.format(iter_val) + '\n'
-
-        username = username_dict[str(sorted_data[iter_val-1][0])]
-        name += username + '\n'
-
-        dist += str(round(sorted_data[iter_val-1][1]/1609, 2)) + '\n'
-        time += str(round(sorted_data[iter_val-1][2]/3600,2)) + '\n'
-        elev += str(round(sorted_data[iter_val-1][3],2)) + '\n'
-        days += str(round(sorted_data[iter_val-1][4],2)) + '\n'
-
-    embed_update.add_field(name='Rank', value=rank, inline=True)
-    embed_update.add_field(name='Name', value=name, inline=True)
-
-    if sort == 'dist':
-        embed_update.add_field(name='Distance (mi)', value=dist, inline=True)
-    elif sort == 'time':
-        embed_update.add_field(name='Time (hr)', value=time, inline=True)
-    elif sort == 'elev':
-        embed_update.add_field(name='Elev Gain (ft)', value=elev, inline=True)
-    elif sort == 'days':
-        embed_update.add_field(name='Active Days', value=days, inline=True)            
-    else:
-        raise ValueError('Bad sort input')
-    
-    return embed_update
+
+# message_id : [guild_id, channel_id, sort, posted_at] of the leaderboards posted by the bot
+# (mirrors the leaderboardMessages table, loaded on first use)
+_leaderboard_messages = None
+
+
+def _leaderboardMessages():
+    '''Returns the registry of posted leaderboard messages (expired ones are dropped when it is loaded)'''
+
+    global _leaderboard_messages
+    if _leaderboard_messages is None:
+        dataDelete('leaderboardMessages', cond_key='posted_at', cond_ineq='<', cond_value=time.time() - leaderboard_message_ttl)
+        rows = dataRead('leaderboardMessages', ['message_id','guild_id','channel_id','sort','posted_at'])
+        _leaderboard_messages = {each[0]: list(each[1:]) for each in rows}
+    return _leaderboard_messages
+
+
+def _registerLeaderboard(message_id, guild_id, channel_id, sort='dist', posted_at=None):
+    '''Record (or update the sort of) a leaderboard message posted by the bot'''
+
+    posted_at = time.time() if posted_at is None else posted_at
+    _leaderboardMessages()[message_id] = [guild_id, channel_id, sort, posted_at]
+    dataEntry('leaderboardMessages', {'message_id': message_id, 'channel_id': channel_id, 'guild_id': guild_id,
+                                      'sort': sort, 'posted_at': posted_at})
+
+
+def _leaderboardMessage(message_id):
+    '''Returns [guild_id, channel_id, sort, posted_at] of a registered leaderboard message
+    (None if the message isn't a leaderboard or it has expired)'''
+
+    registry = _leaderboardMessages()
+    entry = registry.get(message_id)
+    if entry is not None and time.time() - entry[3] > leaderboard_message_ttl:
+        del registry[message_id]
+        dataDelete('leaderboardMessages', cond_key='message_id', cond_ineq='=', cond_value=message_id)
+        return None
+    return entry
+
+
+async def _postLeaderboard(channel, guild_id):
+    '''Send a guild's leaderboard (sorted by distance) to a channel, add the sort reactions, and register it
+
+    Inputs
+        channel : the channel to post the leaderboard in (type:discord.py object)
+        guild_id : (server_id) id number for the server of the leaderboard
+    Returns
+        leaderboard_msg : the message sent
+    '''
+
+    leaderboard_embed = await _createLeaderboard(guild_id)
+    leaderboard_msg = await channel.send(embed=leaderboard_embed)
+    _registerLeaderboard(leaderboard_msg.id, guild_id, channel.id)
+    for emoji in leaderboard_reactions:
+        await leaderboard_msg.add_reaction(emoji)
+    return leaderboard_msg
 
 
 async def _checkIsLeaderboard(guild_id, payload):
     '''Checks whether a given reaction (through payload) was on a leaderboard
     
-    Also removes all user reactions if it is a leaderboard (and if user reacts with wrong emoji)
+    Also removes all user reactions if it is a leaderboard (and if user reacts with wrong emoji).
+    Only messages in the leaderboard registry are considered, so reactions on any other message
+    are dropped without a request to discord.
 
     Inputs
         payload : (type:discord.payload) holds the data for the reaction of discord users
     '''
     
-    if payload.event_type == 'REACTION_ADD':
-        if payload.user_id != bot_id:
-            channel = client.get_channel(payload.channel_id)
-            message = await channel.fetch_message(payload.message_id)
-            
-            if message.author.id == bot_id:
-                if len(message.embeds) > 0:
-                    if 'Activities Leaderboard' in message.embeds[0].to_dict()['title']:
-                        if str(payload.emoji) == '📏':
-                            print('Reacted with Dist')
-                            new_embed = _createLeaderboard(guild_id, sort='dist')
-                        elif str(payload.emoji) == '⌚':
-                            print('Reacted with Time')
-                            new_embed = _createLeaderboard(guild_id, sort='time')
-                        elif str(payload.emoji) == '🪜':
-                            print('Reacted with Elev')
-                            new_embed = _createLeaderboard(guild_id, sort='elev')
-                        elif str(payload.emoji) == '🗓':
-                            print('Reacted with Days')
-                            new_embed = _createLeaderboard(guild_id, sort='days')
-                        else:
-                            print('Reacted with some random emoji, idk.')
-                            await message.remove_reaction(payload.emoji, payload.member)
-                            return
-                        
-                        await message.remove_reaction(payload.emoji, payload.member)
-                        await message.edit(embed = new_embed)
-                    else:
-                        print('Not Leaderboard Message')
-                else:
-                    print('No embeds')
-            else:
-                print('Message not by bot')
-        else:
-            print('reaction not by user')
-    else:
-        print('Not type: REACTION_ADD')
+    if payload.event_type != 'REACTION_ADD' or payload.user_id == bot_id:
+        return
+    entry = _leaderboardMessage(payload.message_id)
+    if entry is None or entry[0] != guild_id:
+        return
+
+    channel = client.get_channel(payload.channel_id)
+    if channel is None:
+        return
+    message = channel.get_partial_message(payload.message_id)
+
+    sort = leaderboard_reactions.get(str(payload.emoji))
+    if sort is None:
+        print('Reacted with some random emoji, idk.')
+        await message.remove_reaction(payload.emoji, payload.member)
+        return
+    print('Reacted with', sort)
+
+    new_embed = await _createLeaderboard(guild_id, sort=sort)
+    await message.remove_reaction(payload.emoji, payload.member)
+    await message.edit(embed = new_embed)
+    if sort != entry[2]:
+        _registerLeaderboard(payload.message_id, guild_id, payload.channel_id, sort, posted_at=entry[3])
 
 
 async def _authorize(ctx):
@@ -688,7 +1969,7 @@ async def _authorize(ctx):
         ctx : (context) the message context (discord.py class)
     '''
 
-    discord_id = str(ctx.message.author.id)
+    discord_id = ctx.message.author.id
     scope = 'activity:read_all'
     redirect_uri = 'https://localhost/exchange_token'
     auth_url = 'https://www.strava.com/oauth/authorize'
@@ -717,7 +1998,7 @@ async def _authorize(ctx):
                'code' : auth_code,
                'grant_type' : 'authorization_code',
                'f' : 'json'}
-    res = requests.post(token_url, data=payload, verify=False).json()
+    res = (await httpPost(token_url, data=payload, verify=False)).json()
 
     ac_token = res['access_token']
     ref_token = res['refresh_token']
@@ -733,11 +2014,13 @@ async def _authorize(ctx):
 
         _id_dict = {'guild_id' : ctx.guild.id,
                     'discord_id' : discord_id,
-                    'strava_id' : None,
+                    'strava_id' : res['athlete']['id'] if 'athlete' in res else None,
                     'username' : ctx.message.author.name}
         
         dataEntry('userTokens', tokens_dict)
         dataEntry('_idTable', _id_dict)
+        _cacheToken(discord_id, ac_token, ref_token, exp_at)
+        _invalidateLeaderboard(ctx.guild.id)
 
         await ctx.send('User Authorized! ({})'.format(ctx.author.display_name))
         await url_message.delete()
@@ -758,7 +2041,7 @@ async def _authorize(ctx):
 
         if len(dataRead('userStats', ['*'],
                        cond_key='discord_id', cond_ineq='=', cond_value=discord_id,
-                       extra_cond='guild_id = {}'.format(ctx.guild.id))) <= 0:
+                       extra_cond=[('guild_id', '=', ctx.guild.id)])) <= 0:
             dataEntry('userStats',initStats)
         else:
             pass
@@ -817,21 +2100,15 @@ async def _showActivity(ctx, activity_id):
         activity_id : activity-specific id for a given activity
     '''
 
-    activity = dataRead('userActivities', ['discord_id'], cond_key='activity_id', cond_ineq='=', cond_value=activity_id)
+    # get the pre-rendered activity embed (rendered now if it isn't stored yet)
+    rendered = await _activityEmbed(activity_id)
 
     #if no activities, return None
-    if len(activity) <= 0:
-        ctx.send('Not Valid Activity ID, please try again')
+    if rendered is None:
+        await ctx.send('Not Valid Activity ID, please try again')
         return None
 
-    # get username and pfp from discord_id
-    discord_id = activity[0][0]
-    user = await client.fetch_user(discord_id)
-    username = user.display_name
-    pfp = user.avatar_url
-
-    # create activity embed and send
-    embed, im_file = await _createActivity(activity_id, pfp, username)
+    embed, im_file = rendered
     message = await ctx.send(embed=embed, file=im_file)
 
     return message
@@ -840,13 +2117,12 @@ async def _showActivity(ctx, activity_id):
 async def _dailyRunningShowcase(guild, channel_id=None, channel_name='daily-activities'):
     '''Displays daily club activities in a "showcase" channel
     
-    (Possible Update : make it so that it is based on channel_id so that guild owners
-     can change the name of the channel and it will still post to correct channel)
-    (Possible Update : add another column to the dailyActivities database with that
-     holds a BOOL (or STR or INT) that signifies whether that activity has been showcased in that guild)
+    A random activity of the guild's day that hasn't been showcased yet is taken from its
+    showcase queue (see _popShowcase)
 
     Inputs
         guild : the guild (server) in which the showcase is to be shown (type:discord.py object)
+        channel_id (optional) : id of the channel in which the showcase is to be displayed
         channel_name (optional) : channel name in which the showcase is to be displayed
     '''
     if channel_id != None:
@@ -862,27 +2138,15 @@ async def _dailyRunningShowcase(guild, channel_id=None, channel_name='daily-acti
             #print('Created Channel')
             return
     
-    # get the daily activities for specified guild
-    dailyActivities = dataRead('dailyActivities',
-                               ['discord_id','activity_id'],
-                               cond_key='guild_id', cond_ineq='=', cond_value=guild.id)
-    if len(dailyActivities) > 0:
-        # get a random activity
-        random.shuffle(dailyActivities)
-        showcase_activity = dailyActivities.pop()
-
-        discord_id = showcase_activity[0]
-        user = await client.fetch_user(discord_id)
-        pfp = user.avatar_url
-        username = user.display_name
-
-        # create activity embed and send to showcase_channel
-        embed, im_file = await _createActivity(showcase_activity[1], pfp, username)
-        message = await showcase_channel.send(embed=embed, file=im_file)
-
-        # delete the activity from the dailyActivities table in the database
-        dataDelete('dailyActivities', cond_key='activity_id', cond_ineq='=', cond_value=showcase_activity[1])
-        print('removed {} from daily activities'.format(showcase_activity[1]))
+    # get a random activity of the day (marked as showcased)
+    activity_id = _popShowcase(guild.id)
+    if activity_id is not None:
+        # get the pre-rendered activity embed and send to showcase_channel
+        rendered = await _activityEmbed(activity_id)
+        if rendered is not None:
+            embed, im_file = rendered
+            message = await showcase_channel.send(embed=embed, file=im_file)
+        print('showcased {} from daily activities'.format(activity_id))
     else:
         print('No Daily Activities')
         await showcase_channel.send('No Daily Activities.')
@@ -901,11 +2165,11 @@ async def _setRoles(guild_id):
     if len(discord_ids) <= 0:
         print('No User Data (no authorized users in _idTable)')
         return
-    discord_ids = ', '.join(discord_ids)
+    discord_ids = [val[0] for val in discord_ids]
 
     user_data = dataRead('userStats', ['discord_id','dist','time','elev','days'],
-                         cond_key='discord_id', cond_ineq='IN', cond_value='({})'.format(discord_ids),
-                         extra_cond='guild_id = {}'.format(guild_id))
+                         cond_key='discord_id', cond_ineq='IN', cond_value=discord_ids,
+                         extra_cond=[('guild_id', '=', guild_id)])
 
     guild = client.get_guild(guild_id)
 
@@ -950,13 +2214,38 @@ async def _setRoles(guild_id):
             else:
                 await guild.create_role(name=role_name, colour=discord.Colour(0x0062ff))
 
-            role = discord.utils.get(guild.roles, name=role_name)
-            user = await client.fetch_user(each[0])
-            await user.add_roles(role)
-    print('Roles Updated for {}'.format(guild.name))
+            role = discord.utils.get(guild.roles, name=role_name)
+            user = await client.fetch_user(each[0])
+            await user.add_roles(role)
+    print('Roles Updated for {}'.format(guild.name))
+
+
+_catalog_lock = None     # (type:asyncio.Lock) routes are cataloged one at a time (see _catalogRoute)
+
+
+async def _catalogRoute(poly, distance):
+    '''Same as _catalogGeometry, with the simplification and the matching run in the compute pool
+
+    (only the sql runs on the event loop, routes are cataloged one at a time so two
+     contributions of the same new route can't both be added to routeGeometry)
+    '''
+
+    global _catalog_lock
+    if _catalog_lock is None:
+        _catalog_lock = asyncio.Lock()
+    geometry = await runCompute(strava_geometry.describe, poly, route_simplify_tolerance, route_cell_size)
+    if geometry is None:
+        return None
+    async with _catalog_lock:
+        geom_id = await runCompute(strava_geometry.find_match, geometry['polyline'], _geometryCandidates(geometry),
+                                   route_match_tolerance, route_match_deviation)
+        if geom_id is None:
+            geom_id = _storeGeometry(geometry, distance)
+            conn.commit()
+    return geom_id
 
 
-async def _addRoute(guild_id, activity_id, route_name, comments, maptype='roadmap', isPublic='False'):
+async def _addRoute(guild_id, activity_id, route_name, comments, isPublic='False'):
     '''Adds route (activity information) to the routes database
     
     Inputs
@@ -964,32 +2253,31 @@ async def _addRoute(guild_id, activity_id, route_name, comments, maptype='roadma
         activity_id : activity-specific id for a given activity
         route_name : the name of the route as defined by the person adding the route
         comments : any comments on the quality of the route (goes through sketch area, big hill, etc.)
-        isPublic (optional) : defines whether other guilds can access this route (type:bool)
+        isPublic (optional) : defines whether other guilds can access this route ('True' or 'False')
+
+    Routes that are near-duplicates of a route already in the catalog (added by any guild)
+    share its stored geometry (and so its maps).
         '''
 
     # possibly create own system for making route_id(s)
     #route_id = random.randrange(0,99999999999,1)
 
-    activity = dataRead('userActivities', ['type','distance','moving_time','elev_gain','polyline'],
+    activity = dataRead('userActivities', ['type','distance','moving_time','elev_gain','geometry'],
                         cond_key='activity_id', cond_ineq='=', cond_value=activity_id)
 
     if len(activity) > 0:
 
-        if os.path.isfile('obj/activitymaps/{}_{}.png'.format(activity_id, maptype)):
-            filename = 'obj/activitymaps/{}_{}.png'.format(activity_id, maptype)
-        else:
-            # activity map doesnt exist so create map
-            embed, filename = await _createActivity(activity_id, pfp=None, username=None, maptype='roadmap')
+        geom_id = await _catalogRoute(strava_geometry.unpack_polyline(activity[0][4]), activity[0][1])
 
-    
         route = {'route_id':activity_id,
                  'route_name':route_name,
                  'type':activity[0][0],
-                 'filename':filename,
                  'distance':activity[0][1],
                  'average_moving_time':activity[0][2],
                  'elev_gain':activity[0][3],
-                 'polyline':activity[0][4],
+                 'polyline':None,
+                 'geometry':activity[0][4],
+                 'geom_id':geom_id,
                  'comments':comments,
                  'guild_id':guild_id,
                  'isPublic':isPublic}
@@ -1000,15 +2288,68 @@ async def _addRoute(guild_id, activity_id, route_name, comments, maptype='roadma
         print('Activity not in database')
 
 
+def _sampleRoutes(guild_id, radius=None):
+    '''Pick one random route from each distance band (route_bands) for a guild
+
+    Candidates are the distinct route geometries of the guild's routes, and of public routes
+    (from any guild) whose centroid is within radius km of the club center (bounding boxes are
+    matched in the geometryIndex R*Tree first). Without a center, only the guild's own routes are
+    used. The bands are assigned and sampled in a single query that only handles geometry ids,
+    then the names and polylines are read for the chosen routes alone.
+
+    Inputs
+        guild_id : (server_id) id number of the guild
+        radius (optional) : search radius in km (defaults to route_search_radius)
+    Returns
+        routes : list of (route_name, polyline, distance) of the chosen routes, shortest band first
+                 (named after the guild's own route when it has one)
+    '''
+
+    settings = _guildSettings(guild_id)
+    center = settings.center() if settings is not None else None
+    if center is None:
+        source = 'routeGeometry g WHERE EXISTS (SELECT 1 FROM routes r WHERE r.geom_id = g.geom_id AND r.guild_id = ?)'
+        params = (guild_id,)
+    else:
+        radius = route_search_radius if radius is None else radius
+        lat, lon = center
+        d_lat = radius / 111.2
+        d_lon = radius / (111.2 * max(math.cos(math.radians(lat)), 0.01))
+        source = "geometryIndex i JOIN routeGeometry g ON g.geom_id = i.geom_id \
+                  WHERE i.max_lat >= ? AND i.min_lat <= ? AND i.max_lon >= ? AND i.min_lon <= ? \
+                  AND haversine(?, ?, g.center_lat, g.center_lon) <= ? \
+                  AND EXISTS (SELECT 1 FROM routes r WHERE r.geom_id = g.geom_id AND (r.guild_id = ? OR r.isPublic = 'True'))"
+        params = (lat - d_lat, lat + d_lat, lon - d_lon, lon + d_lon, lat, lon, radius, guild_id)
+
+    band = ' '.join('WHEN g.distance < ? THEN {}'.format(i) for i in range(len(route_bands)))
+    chosen = c.execute('SELECT geom_id FROM ( \
+                          SELECT geom_id, band, ROW_NUMBER() OVER (PARTITION BY band ORDER BY random()) AS pick FROM ( \
+                            SELECT g.geom_id, CASE {} ELSE {} END AS band FROM {} AND g.distance IS NOT NULL)) \
+                        WHERE pick = 1 ORDER BY band'.format(band, len(route_bands), source),
+                       tuple(route_bands) + params).fetchall()
+    chosen = [each[0] for each in chosen]
+    if len(chosen) == 0:
+        return []
+
+    rows = c.execute("SELECT g.geom_id, (SELECT r.route_name FROM routes r WHERE r.geom_id = g.geom_id \
+                                          AND (r.guild_id = ? OR r.isPublic = 'True') \
+                                          ORDER BY r.guild_id = ? DESC, r.route_id LIMIT 1), g.polyline, g.distance \
+                      FROM routeGeometry g WHERE g.geom_id IN ({})".format(','.join('?'*len(chosen))),
+                     (guild_id, guild_id) + tuple(chosen)).fetchall()
+    rows = {row[0]: row[1:] for row in rows}
+    return [rows[each] for each in chosen if each in rows]
+
+
 async def _showRecommended(guild, channel_id=None, channel_name='recommended-routes'):
     '''creates and sends recommended routes to the specified channel
     
-    (Needed Updates: add an average Lat/Lon value to the routes table, and have a conditional that
-     the polyline average should be within a certain distance of the club center)
+    One route of each distance band is chosen by _sampleRoutes (within route_search_radius of the
+    club center when it is set)
 
     Inputs
-        guild_id : 
-        channel_name (optional) : 
+        guild : the guild to recommend routes to
+        channel_id (optional) : id of the channel to send the routes to
+        channel_name (optional) : name of the channel to use when channel_id is not given
         '''
     
     guild_id = guild.id
@@ -1026,29 +2367,7 @@ async def _showRecommended(guild, channel_id=None, channel_name='recommended-rou
             #print('Created Channel')
             return
     
-    short_routes = dataRead('routes',
-                            ['route_name','type','polyline','filename','distance','average_moving_time','elev_gain','comments'],
-                            cond_key='guild_id', cond_ineq='=', cond_value=guild_id,
-                            extra_cond='distance < 4887')
-    medium_routes = dataRead('routes',
-                            ['route_name','type','polyline','filename','distance','average_moving_time','elev_gain','comments'],
-                            cond_key='guild_id', cond_ineq='=', cond_value=guild_id,
-                            extra_cond='distance < 8045 AND distance > 4887')
-    long_routes = dataRead('routes',
-                            ['route_name','type','polyline','filename','distance','average_moving_time','elev_gain','comments'],
-                            cond_key='guild_id', cond_ineq='=', cond_value=guild_id,
-                            extra_cond='distance > 8045')
-
-    # shuffle lists
-    random.shuffle(short_routes)
-    random.shuffle(medium_routes)
-    random.shuffle(long_routes)
-
-    # combine polylines into one
-    now = datetime.datetime.now().strftime("%m-%d-%Y_%H-%M-%S")
-
-    # create unique file ID
-    map_fileId = str(now)
+    routes = _sampleRoutes(guild_id)
 
     #create embed
     embed = discord.Embed(title="Recommended Routes",
@@ -1056,36 +2375,480 @@ async def _showRecommended(guild, channel_id=None, channel_name='recommended-rou
                             color=0x00ff00)
 
     poly_list = []
-    if len(short_routes) > 0:
-        if len(short_routes[0]) == 8:
-            #print(short_routes[0])
-            poly_list.append(short_routes[0][2])
-            embed.add_field(name=short_routes[0][0], value=str(round(short_routes[0][4]/1609,2))+' mi', inline=True)
-    if len(medium_routes) > 0:
-        if len(medium_routes[0]) == 8:
-            #print(medium_routes[0])
-            poly_list.append(medium_routes[0][2])
-            embed.add_field(name=medium_routes[0][0], value=str(round(medium_routes[0][4]/1609,2))+' mi', inline=True)
-    if len(long_routes) > 0:
-        if len(long_routes[0]) == 8:
-            #print(long_routes[0])
-            poly_list.append(long_routes[0][2])
-            embed.add_field(name=long_routes[0][0], value=str(round(long_routes[0][4]/1609,2))+' mi', inline=True)
+    for route_name, poly, distance in routes:
+        poly_list.append(poly)
+        embed.add_field(name=route_name, value=str(round(distance/1609,2))+' mi', inline=True)
     
     if len(poly_list) == 0:
         await rec_channel.send('No Saved Routes.')
         raise NoActivitiesError('No Added Routes in Guild')
 
-    map_im = multiPoly_toMap(map_fileId, poly_list, maptype='roadmap', m_size='640x640')
-    map_filename = 'obj/recommendedmaps/{}.png'.format(map_fileId)
-    
-    file = discord.File(map_filename, filename="recMap.png")
-    embed.set_image(url="attachment://recMap.png")
+    map_data = (await multiPoly_toMap(poly_list, maptype='roadmap', m_size='640x640'))[0]
+
+    file = None
+    if map_data is not None:
+        file = discord.File(io.BytesIO(map_data), filename="recMap.png")
+        embed.set_image(url="attachment://recMap.png")
 
     #send embed
     await rec_channel.send(file=file, embed=embed)
 
 
+# ==================================================== #
+# ||||||        Token Refresh Scheduler         |||||| #
+# ==================================================== #
+
+_tokens = None          # discord_id (int) : [ac_token, ref_token, exp_at] (mirrors userTokens, loaded on first use)
+_refresh_heap = []      # heap of (refresh_at, discord_id) (entries that don't match _refresh_at are stale)
+_refresh_at = {}        # discord_id : time of the user's next scheduled refresh
+_refresh_failures = {}  # discord_id : number of consecutive failed refreshes
+_refreshing = {}        # discord_id : future of the refresh in progress
+_refresh_wake = None    # (type:asyncio.Event) set when the schedule changes
+_refresh_task = None
+
+
+def _userTokens():
+    '''Returns the token cache (loaded from userTokens, and every refresh scheduled, on first use)'''
+
+    global _tokens
+    if _tokens is None:
+        _tokens = {}
+        for each in dataRead('userTokens', ['discord_id','ac_token','ref_token','exp_at']):
+            _tokens[each[0]] = [each[1], each[2], each[3]]
+            _scheduleRefresh(each[0])
+    return _tokens
+
+
+def _scheduleRefresh(discord_id, refresh_at=None):
+    '''Schedule a user's next token refresh
+
+    Inputs
+        discord_id : discord identifying number of the user
+        refresh_at (optional) : time of the refresh (default: a random time shortly before the token expires)
+    '''
+
+    discord_id = int(discord_id)
+    if refresh_at is None:
+        refresh_at = _tokens[discord_id][2] - token_refresh_margin - random.uniform(0, token_refresh_jitter)
+    _refresh_at[discord_id] = refresh_at
+    heapq.heappush(_refresh_heap, (refresh_at, discord_id))
+    if _refresh_wake is not None:
+        _refresh_wake.set()
+
+
+def _cacheToken(discord_id, ac_token, ref_token, exp_at):
+    '''Put a user's new tokens in the token cache and schedule their refresh (userTokens is written by the caller)'''
+
+    discord_id = int(discord_id)
+    _userTokens()[discord_id] = [ac_token, ref_token, exp_at]
+    _refresh_failures.pop(discord_id, None)
+    _scheduleRefresh(discord_id)
+
+
+def _forgetToken(discord_id):
+    '''Remove a user from the token cache (and cancel their refreshes)'''
+
+    discord_id = int(discord_id)
+    if _tokens is not None:
+        _tokens.pop(discord_id, None)
+    _synced_at.pop(discord_id, None)
+    _refresh_at.pop(discord_id, None)
+    _refresh_failures.pop(discord_id, None)
+
+
+async def _accessToken(discord_id, priority=PRIORITY_BACKGROUND):
+    '''Returns a valid access token of a user from the token cache
+
+    The token is refreshed first if it has expired (ex: the bot was offline)
+
+    Inputs
+        discord_id : discord identifying number of the user
+        priority (optional) : strava quota priority of the refresh, if one is needed
+    Returns
+        ac_token : the access token (None if the user isn't authorized or the refresh failed)
+    '''
+
+    discord_id = int(discord_id)
+    token = _userTokens().get(discord_id)
+    if token is None:
+        return None
+    if token[2] > time.time() + 60:
+        return token[0]
+    if await _refreshToken(discord_id, priority):
+        return _tokens[discord_id][0]
+    return None
+
+
+async def _refreshToken(discord_id, priority=PRIORITY_BACKGROUND):
+    '''Refresh a user's access token (concurrent calls for the same user share one request)
+
+    Returns
+        refreshed : True if the user has a new token
+    '''
+
+    future = _refreshing.get(discord_id)
+    if future is None:
+        future = asyncio.ensure_future(_requestToken(discord_id, priority))
+        _refreshing[discord_id] = future
+        future.add_done_callback(lambda f: _refreshing.pop(discord_id, None))
+    return await asyncio.shield(future)
+
+
+async def _requestToken(discord_id, priority):
+    '''Request a new access token from strava and store it (a failed refresh is retried with backoff)'''
+
+    token = _userTokens().get(discord_id)
+    if token is None:
+        return False
+
+    refreshToken_payload = {'client_id' : client_id,
+                            'client_secret' : client_secret,
+                            'refresh_token' : token[1],
+                            'grant_type' : 'refresh_token',
+                            'f' : 'json'}
+    res = None
+    try:
+        # make request to strava api to update access tokens (returns new access and refresh tokens)
+        res = await httpPost('https://www.strava.com/oauth/token', data=refreshToken_payload, verify=False,
+                             priority=priority)
+        res = res.json() if res.status == 200 else None
+    except Exception as e:
+        print('Token refresh request failed for user {} ({})'.format(discord_id, e))
+
+    if discord_id not in _tokens:
+        # user was removed while the request was in flight
+        return False
+
+    if res is None or 'access_token' not in res:
+        failures = _refresh_failures.get(discord_id, 0) + 1
+        _refresh_failures[discord_id] = failures
+        delay = min(token_retry_max, token_retry_base * 2**(failures - 1)) * random.uniform(0.5, 1.5)
+        print('Token refresh failed for user {} (attempt {}), retrying in {}s'.format(discord_id, failures, int(delay)))
+        _scheduleRefresh(discord_id, time.time() + delay)
+        return False
+
+    # update the new token values in the database and the token cache
+    dataUpdate('userTokens', ['ref_token','ac_token','exp_at'],
+               [res['refresh_token'], res['access_token'], res['expires_at']],
+               cond_key='discord_id', cond_ineq='=', cond_value=discord_id)
+    _cacheToken(discord_id, res['access_token'], res['refresh_token'], res['expires_at'])
+    return True
+
+
+async def _tokenRefresher():
+    '''Refresh access tokens as they come due (runs for the lifetime of the bot)'''
+
+    _userTokens()
+    while True:
+        _refresh_wake.clear()
+        while len(_refresh_heap) > 0 and _refresh_heap[0][0] <= time.time():
+            refresh_at, discord_id = heapq.heappop(_refresh_heap)
+            if _refresh_at.get(discord_id) != refresh_at:
+                continue
+            del _refresh_at[discord_id]
+            asyncio.ensure_future(_refreshToken(discord_id))
+            await asyncio.sleep(token_refresh_spacing)
+
+        # sleep until the next refresh is due (or the schedule changes)
+        timer = None
+        if len(_refresh_heap) > 0:
+            timer = asyncio.get_running_loop().call_later(max(0, _refresh_heap[0][0] - time.time()), _refresh_wake.set)
+        try:
+            await _refresh_wake.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+
+def _startTokenRefresher():
+    '''Start the token refresh scheduler (once)'''
+
+    global _refresh_task, _refresh_wake
+    if _refresh_task is None or _refresh_task.done():
+        _refresh_wake = asyncio.Event()
+        _refresh_task = asyncio.ensure_future(_tokenRefresher())
+
+
+# ==================================================== #
+# ||||||        Activity Embed Pipeline         |||||| #
+# ==================================================== #
+
+# activity ids waiting to be pre-rendered (filled by _storeActivities, drained by _embedWorker)
+_embed_queue = asyncio.Queue()
+_embed_worker = None
+
+
+def _queueEmbeds(rows):
+    '''Queue recent activities (userActivities rows) to have their embed pre-rendered'''
+
+    oldest = datetime.date.today() - datetime.timedelta(days=embed_prerender_days)
+    for each in rows:
+        if datetime.date(each['year'], each['month'], each['day']) >= oldest:
+            _embed_queue.put_nowait(each['activity_id'])
+
+
+async def _prerenderActivity(activity_id):
+    '''Render an activity embed and map (map into map_cache) and store it in activityEmbeds
+
+    Inputs
+        activity_id : activity-specific id for a given activity
+    Returns
+        embed, im_file : same as _createActivity (None if the activity doesn't exist)
+    '''
+
+    activity = dataRead('userActivities', ['discord_id'], cond_key='activity_id', cond_ineq='=', cond_value=activity_id)
+    if len(activity) <= 0:
+        return None
+
+    # get username and pfp from discord_id
+    user = client.get_user(activity[0][0])
+    if user is None:
+        try:
+            user = await client.fetch_user(activity[0][0])
+        except Exception as e:
+            print('Could not get user {} ({})'.format(activity[0][0], e))
+    username = user.display_name if user is not None else None
+    pfp = user.avatar_url if user is not None else None
+
+    rendered = await _createActivity(activity_id, pfp, username)
+    if rendered is None:
+        return None
+    embed, im_file, map_key = rendered
+
+    # (map_key is the key the map was actually cached under, ex: google's after a failed local render)
+    dataEntry('activityEmbeds', {'activity_id': activity_id,
+                                 'embed': json.dumps(embed.to_dict()),
+                                 'map_key': map_key,
+                                 'created_at': time.time()})
+    return embed, im_file
+
+
+async def _activityEmbed(activity_id):
+    '''Returns the stored (pre-rendered) embed and map of an activity
+
+    Falls back to rendering (and storing) it if it isn't stored or its map was evicted from map_cache
+
+    Inputs
+        activity_id : activity-specific id for a given activity
+    Returns
+        embed, im_file : same as _createActivity (None if the activity doesn't exist)
+    '''
+
+    stored = dataRead('activityEmbeds', ['embed','map_key'], cond_key='activity_id', cond_ineq='=', cond_value=activity_id)
+    if len(stored) > 0:
+        embed = discord.Embed.from_dict(json.loads(stored[0][0]))
+        if stored[0][1] is None:
+            return embed, None
+        map_data = map_cache.get(stored[0][1])
+        if map_data is not None:
+            return embed, discord.File(io.BytesIO(map_data), filename='map.png')
+    return await _prerenderActivity(activity_id)
+
+
+async def _embedWorker():
+    '''Pre-render queued activities one at a time (runs for the lifetime of the bot)'''
+
+    while True:
+        activity_id = await _embed_queue.get()
+        try:
+            # (renders only if it wasn't already rendered since it was queued)
+            await _activityEmbed(activity_id)
+        except Exception as e:
+            print('Failed to pre-render activity {} ({})'.format(activity_id, e))
+        finally:
+            _embed_queue.task_done()
+
+
+def _startEmbedWorker():
+    '''Start the embed pipeline worker (once)'''
+
+    global _embed_worker
+    if _embed_worker is None or _embed_worker.done():
+        _embed_worker = asyncio.ensure_future(_embedWorker())
+
+
+# ==================================================== #
+# ||||||         Strava Webhook Receiver        |||||| #
+# ==================================================== #
+
+_webhook_runner = None
+_webhook_tasks = set()      # events being handled (referenced so they aren't garbage collected)
+
+
+def _removeUser(discord_id):
+    '''Delete all stored data (tokens, stats, activities) of a user'''
+
+    activity_ids = dataRead('userActivities', ['activity_id'], cond_key='discord_id', cond_ineq='=', cond_value=discord_id)
+    with transaction():
+        dataDelete('activityEmbeds', cond_key='activity_id', cond_ineq='IN', cond_value=[x[0] for x in activity_ids])
+        dataDelete('userTokens', cond_key='discord_id', cond_ineq='=', cond_value=discord_id)
+        dataDelete('userStats', cond_key='discord_id', cond_ineq='=', cond_value=discord_id)
+        dataDelete('userActivities', cond_key='discord_id', cond_ineq='=', cond_value=discord_id)
+        dataDelete('dailyActivities', cond_key='discord_id', cond_ineq='=', cond_value=discord_id)
+        dataDelete('syncCursors', cond_key='discord_id', cond_ineq='=', cond_value=discord_id)
+        dataDelete('_idTable', cond_key='discord_id', cond_ineq='=', cond_value=discord_id)
+    _forgetToken(discord_id)
+    _invalidateLeaderboard()
+
+
+async def _fetchActivity(discord_id, activity_id):
+    '''Fetch a single activity from strava and write it to userActivities (and the user's userStats)
+
+    Returns
+        activity : the userActivities row (dict) written, or None if it could not be fetched
+    '''
+
+    ac_token = await _accessToken(discord_id)
+    if ac_token is None:
+        return None
+
+    res = await httpGet('https://www.strava.com/api/v3/activities/{}'.format(int(activity_id)),
+                        headers={'Authorization': 'Bearer ' + ac_token},
+                        priority=PRIORITY_BACKGROUND)
+    if res.status != 200:
+        print('Could not fetch activity: {} (status {})'.format(activity_id, res.status))
+        return None
+
+    activity = _activityRow(discord_id, res.json())
+    _storeActivities(discord_id, [activity])
+    return activity
+
+
+async def _handleWebhookEvent(event):
+    '''Apply a strava push subscription event (activity create/update/delete, athlete deauthorize)
+
+    Inputs
+        event : (type:dict) the event posted by strava
+                (object_type, object_id, aspect_type, owner_id, updates, event_time, subscription_id)
+    '''
+
+    user = dataRead('_idTable', ['discord_id'], cond_key='strava_id', cond_ineq='=', cond_value=int(event['owner_id']), fetchOne=True)
+    if user is None:
+        print('Webhook event for unknown athlete:', event['owner_id'])
+        return
+    discord_id = user[0]
+
+    if event['object_type'] == 'activity':
+        activity_id = int(event['object_id'])
+        if event['aspect_type'] in ['create', 'update']:
+            await _fetchActivity(discord_id, activity_id)
+        elif event['aspect_type'] == 'delete':
+            _deleteActivities(discord_id, [activity_id])
+        print('Webhook {} activity: {}'.format(event['aspect_type'], activity_id))
+
+    elif event['object_type'] == 'athlete':
+        if str(event.get('updates', {}).get('authorized', '')).lower() == 'false':
+            if await _confirmDeauthorized(discord_id):
+                _removeUser(discord_id)
+                print('Webhook deauthorized user:', discord_id)
+            else:
+                print('Webhook deauthorization not confirmed by strava, keeping user:', discord_id)
+
+
+async def _confirmDeauthorized(discord_id):
+    '''Check with strava that a user revoked the bot's access (events aren't signed, so a
+    deauthorization is only acted on when strava rejects the user's refresh token)
+
+    Returns
+        deauthorized : True if strava rejected the refresh token
+    '''
+
+    token = _userTokens().get(discord_id)
+    if token is None:
+        return False
+
+    refreshToken_payload = {'client_id' : client_id,
+                            'client_secret' : client_secret,
+                            'refresh_token' : token[1],
+                            'grant_type' : 'refresh_token',
+                            'f' : 'json'}
+    try:
+        res = await httpPost('https://www.strava.com/oauth/token', data=refreshToken_payload, verify=False,
+                             priority=PRIORITY_BACKGROUND)
+    except Exception as e:
+        print('Token refresh request failed for user {} ({})'.format(discord_id, e))
+        return False
+
+    if res.status == 200:
+        # still authorized, keep the new tokens
+        res = res.json()
+        if 'access_token' in res and discord_id in _tokens:
+            dataUpdate('userTokens', ['ref_token','ac_token','exp_at'],
+                       [res['refresh_token'], res['access_token'], res['expires_at']],
+                       cond_key='discord_id', cond_ineq='=', cond_value=discord_id)
+            _cacheToken(discord_id, res['access_token'], res['refresh_token'], res['expires_at'])
+        return False
+    return res.status in [400, 401]
+
+
+async def _webhookValidate(request):
+    '''GET handler for the subscription validation handshake (echo hub.challenge)'''
+
+    if request.query.get('hub.mode') == 'subscribe' and request.query.get('hub.verify_token') == webhook_verify_token:
+        return web.json_response({'hub.challenge': request.query.get('hub.challenge')})
+    return web.Response(status=403)
+
+
+async def _webhookEvent(request):
+    '''POST handler for subscription events
+
+    Strava expects a 200 within 2 seconds, so the event is handled in the background
+    '''
+
+    try:
+        event = await request.json()
+        event['owner_id'], event['object_type'], event['object_id']
+    except (ValueError, KeyError, TypeError):
+        return web.Response(status=400)
+    if str(event.get('subscription_id')) != webhook_subscription_id:
+        print('Webhook event for unknown subscription:', event.get('subscription_id'))
+        return web.Response(status=403)
+
+    async def handle():
+        try:
+            await _handleWebhookEvent(event)
+        except Exception as exc:
+            print('Error handling webhook event:', exc)
+
+    task = asyncio.ensure_future(handle())
+    _webhook_tasks.add(task)
+    task.add_done_callback(_webhook_tasks.discard)
+    return web.Response(status=200)
+
+
+def _webhookApp():
+    '''Returns the aiohttp application serving the webhook endpoint'''
+
+    app = web.Application()
+    app.router.add_get(webhook_path, _webhookValidate)
+    app.router.add_post(webhook_path, _webhookEvent)
+    return app
+
+
+async def _startWebhookServer():
+    '''Start the webhook endpoint on webhook_host:webhook_port (once, if it is enabled and configured)'''
+
+    global _webhook_runner
+    if _webhook_runner is not None or not webhook_enabled:
+        return
+    if not webhook_verify_token or not webhook_subscription_id:
+        print('Webhook not started: set STRAVA_WEBHOOK_VERIFY_TOKEN and STRAVA_WEBHOOK_SUBSCRIPTION_ID (polling for activities instead)')
+        return
+    _webhook_runner = web.AppRunner(_webhookApp())
+    await _webhook_runner.setup()
+    await web.TCPSite(_webhook_runner, webhook_host, webhook_port).start()
+    print('Webhook listening on {}:{}{}'.format(webhook_host, webhook_port, webhook_path))
+
+
+async def _stopWebhookServer():
+    '''Stop the webhook endpoint'''
+
+    global _webhook_runner
+    if _webhook_runner is not None:
+        await _webhook_runner.cleanup()
+        _webhook_runner = None
+
+
 
 
 
@@ -1112,6 +2875,9 @@ async def help(ctx):
     embed.add_field(name="setLeaderboard", value='(Admin Only) sets a default channel to post recurring leaderboard\n(can also use "set-l")', inline=False)
     embed.add_field(name="setShowcase", value='(Admin Only) sets a default channel to post recurring showcase\n(can also use "set-s")', inline=False)
     embed.add_field(name="setRecommended", value='(Admin Only) sets a default channel to post recurring recommended activities\n(can also use "set-r")', inline=False)
+    embed.add_field(name="quota", value='(Admin Only) shows the remaining strava api requests', inline=False)
+    embed.add_field(name="mapCache", value='(Admin Only) shows the hit/miss counters of the map image cache', inline=False)
+    embed.add_field(name="timezone", value='(Admin Only) sets the time zone the daily showcase follows (ex: America/Denver)\n(can also use "tz")', inline=False)
     embed.add_field(name="frequency", value='(Admin Only) sets a default frequency for leaderboard, showcase, and recommended routes posting\nin addition to the updates to user activities\n(can also use "freq")', inline=False)
     
     message = await ctx.send(embed=embed)
@@ -1134,6 +2900,41 @@ async def ping(ctx):
     some extra text to test help command'''
     await ctx.send('{}ms'.format(round(client.latency*1000)))
 
+@client.command()
+@commands.guild_only()
+@commands.has_permissions(manage_channels=True)
+async def quota(ctx):
+    '''Show the Remaining Strava API Quota'''
+    headroom = strava_governor.headroom()
+    embed = discord.Embed(title='Strava API Quota', color=0x00ff00)
+    for name in headroom:
+        window = headroom[name]
+        embed.add_field(name=name,
+                        value='{}/{} left\nresets in {}'.format(window['remaining'], window['limit'],
+                                                               datetime.timedelta(seconds=window['reset_in'])),
+                        inline=True)
+    embed.add_field(name='queued', value=str(strava_governor.queued()), inline=True)
+    await ctx.send(embed=embed)
+
+
+@client.command()
+@commands.guild_only()
+@commands.has_permissions(manage_channels=True)
+async def mapCache(ctx):
+    '''Show the Map Image Cache Counters'''
+    stats = map_cache.stats()
+    embed = discord.Embed(title='Map Cache', color=0x00ff00)
+    embed.add_field(name='hits', value='{} memory\n{} disk'.format(stats['memory_hits'], stats['disk_hits']), inline=True)
+    embed.add_field(name='misses', value=str(stats['misses']), inline=True)
+    embed.add_field(name='hit rate', value='{:.0%}'.format(stats['hit_rate']), inline=True)
+    embed.add_field(name='size',
+                    value='{} in memory\n{:.1f}/{:.0f} MB on disk'.format(stats['memory_entries'], stats['disk_bytes']/2**20,
+                                                                         map_cache.disk_budget/2**20),
+                    inline=True)
+    embed.add_field(name='evictions', value=str(stats['evictions']), inline=True)
+    await ctx.send(embed=embed)
+
+
 @client.command()
 @commands.guild_only()
 async def authorize(ctx):
@@ -1146,13 +2947,9 @@ async def authorize(ctx):
 @commands.has_role("Authorized")
 async def unauthorize(ctx):
     '''Unauthorize Individual User'''
-    discord_id = str(ctx.message.author.id)
+    discord_id = ctx.message.author.id
 
-    dataDelete('userTokens', cond_key='discord_id', cond_ineq='=', cond_value=discord_id)
-    dataDelete('userStats', cond_key='discord_id', cond_ineq='=', cond_value=discord_id)
-    dataDelete('userActivities', cond_key='discord_id', cond_ineq='=', cond_value=discord_id)
-    dataDelete('dailyActivities', cond_key='discord_id', cond_ineq='=', cond_value=discord_id)
-    dataDelete('_idTable', cond_key='discord_id', cond_ineq='=', cond_value=discord_id)
+    _removeUser(discord_id)
 
     await ctx.send('Unauthorized User: ' + ctx.message.author.name)
     
@@ -1167,12 +2964,7 @@ async def unauthorize(ctx):
 async def leaderboard(ctx):
     '''Create and Sends Club Leaderboard'''
     try:
-        leaderboard_embed = _createLeaderboard(ctx.guild.id)
-        leaderboard_msg = await ctx.send(embed=leaderboard_embed)
-        await leaderboard_msg.add_reaction('📏') #dist
-        await leaderboard_msg.add_reaction('⌚') #time
-        await leaderboard_msg.add_reaction('🪜')  #elev
-        await leaderboard_msg.add_reaction('🗓') #days
+        await _postLeaderboard(ctx.channel, ctx.guild.id)
     except:
         print('Error in creating leaderboard for guild:',ctx.guild.id)
 
@@ -1181,24 +2973,29 @@ async def leaderboard(ctx):
 @commands.guild_only()
 @commands.has_permissions(manage_channels=True)
 async def addRoute(ctx, *, commInput):
-    '''*Not Yet Implemented*'''
+    '''Adds one of your activities as a route of the guild
+
+    Inputs
+        commInput : <activity_id//route_name//comments> (add //public to share it with nearby guilds)
+    '''
     try:
         guild_id = ctx.guild.id
-        if len(commInput.split('//')) == 3:
-            activity_id, route_name, comments = commInput.split('//')
+        if len(commInput.split('//')) in [3, 4]:
+            activity_id, route_name, comments = commInput.split('//')[:3]
+            isPublic = 'True' if commInput.split('//')[3:] == ['public'] else 'False'
 
             #print(activity_id)
             #print(route_name)
             #print(comments)
 
             if activity_id.isnumeric():
-                await _addRoute(guild_id, int(activity_id), route_name, comments)
+                await _addRoute(guild_id, int(activity_id), route_name, comments, isPublic=isPublic)
                 await ctx.message.add_reaction('✅')
             else:
                 await ctx.send('activity_id incorrect type (Expected type(int))')
                 await ctx.message.add_reaction('❌')
         else:
-            await ctx.send('Not correct number of inputs (Expected 3, with "//" separator)')
+            await ctx.send('Not correct number of inputs (Expected 3 or 4, with "//" separator)')
             await ctx.message.add_reaction('❌')
     except Exception as exc:
         print(exc)
@@ -1264,7 +3061,10 @@ async def close(ctx):
     
     await ctx.send("I'm Logging Off in 4 seconds")
     print('Strava Bot Closing')
-    time.sleep(4)
+    await asyncio.sleep(4)
+    await _stopWebhookServer()
+    await httpClose()
+    computeClose()
     await client.close()
 
 
@@ -1274,19 +3074,14 @@ async def close(ctx):
 async def updateActivities(ctx):
     '''Updates User activities'''
     guild_id = ctx.message.guild.id
-    _updateUserActivities(guild_id, num_activities=99)
+    await _ensureSynced(_guildMembers(guild_id), priority=PRIORITY_INTERACTIVE)
     try:
         print('Attempting to update userStats')
         _updateUserStats(guild_id)
+        await ctx.message.add_reaction('✅')
     except Exception as exce:
         await ctx.send('Could not update userStats')
         print(exce)
-    try:
-        print('Attempting to update daily activities')
-        _updateDailyActivities(guild_id)
-        await ctx.message.add_reaction('✅')
-    except:
-        await ctx.send('Could not update dailyActivities for guild:',guild_id)
 
 
 # ==================================================== #
@@ -1314,34 +3109,17 @@ async def addType(ctx, *, type):
             return
 
         guild_id = ctx.guild.id
-        settings = dataRead('guildSettings',
-                            ['guild_id','types',
-                             'lead_id','show_id','rec_id','lat_lon_center',
-                             'lead_freq','show_freq','rec_freq','update_freq'],
-                            cond_key='guild_id', cond_ineq='=', cond_value=guild_id)
-        #print(type)
-        if len(settings) > 0:
-            if type not in settings[0][1].split(','):
-                updateSettings = {'guild_id':guild_id,
-                                  'types':settings[0][1]+','+type,
-                                  'lead_id':settings[0][2],
-                                  'show_id':settings[0][3],
-                                  'rec_id':settings[0][4],
-                                  'lat_lon_center':settings[0][5],
-                                  'lead_freq':settings[0][6],
-                                  'show_freq':settings[0][7],
-                                  'rec_freq':settings[0][8],
-                                  'update_freq':settings[0][9]}
-                dataEntry('guildSettings',updateSettings)
-                await ctx.message.add_reaction('✅')
-                print('Add activity type:',type)
-            else:
-                print('type already in list')
-        else:
-            updateSettings = {'types':type, 'guild_id':guild_id}
-            dataEntry('guildSettings',updateSettings)
-            print('Add activity type:',type)
-            await ctx.message.add_reaction('✅')
+        settings = _guildSettings(guild_id)
+        if settings is not None and type in settings.types:
+            print('type already in list')
+            return
+
+        types = settings.types if settings is not None else set()
+        _updateGuildSettings(guild_id, {'types': types | {type}})
+        # totals only count the guild's types, so rebuild them
+        _updateUserStats(guild_id)
+        await ctx.message.add_reaction('✅')
+        print('Add activity type:',type)
     except:
         print('Could not addType({}) for guild: {}'.format(type, ctx.guild.id))
 
@@ -1358,30 +3136,10 @@ async def setLeaderboard(ctx):
 
     try:
         guild_id = ctx.guild.id
-        settings = dataRead('guildSettings',
-                            ['guild_id','types',
-                             'lead_id','show_id','rec_id','lat_lon_center',
-                             'lead_freq','show_freq','rec_freq','update_freq'],
-                            cond_key='guild_id', cond_ineq='=', cond_value=guild_id)
-        if len(settings) > 0:
-            print('lead_channel_id:',ctx.message.channel.id)
-            updateSettings = {'guild_id':guild_id,
-                                'types':settings[0][1],
-                                'lead_id':ctx.message.channel.id,
-                                'show_id':settings[0][3],
-                                'rec_id':settings[0][4],
-                                'lat_lon_center':settings[0][5],
-                                'lead_freq':settings[0][6],
-                                'show_freq':settings[0][7],
-                                'rec_freq':settings[0][8],
-                                'update_freq':settings[0][9]}
-            dataEntry('guildSettings',updateSettings)
-            await ctx.message.add_reaction('✅')
-        else:
-            print('lead_channel_id:',ctx.message.channel.id)
-            update_settings = {'guild_id':guild_id, 'lead_id':ctx.message.channel.id}
-            dataEntry('guildSettings',updateSettings)
-            await ctx.message.add_reaction('✅')
+        print('lead_channel_id:',ctx.message.channel.id)
+        _updateGuildSettings(guild_id, {'lead_id': ctx.message.channel.id})
+        _scheduleGuild(guild_id)
+        await ctx.message.add_reaction('✅')
     except:
         print('Could not set leaderboard channel for guild:',ctx.guild.id)
 
@@ -1397,30 +3155,10 @@ async def setShowcase(ctx):
 
     try:
         guild_id = ctx.guild.id
-        settings = dataRead('guildSettings',
-                            ['guild_id','types',
-                             'lead_id','show_id','rec_id','lat_lon_center',
-                             'lead_freq','show_freq','rec_freq','update_freq'],
-                            cond_key='guild_id', cond_ineq='=', cond_value=guild_id)
-        if len(settings) > 0:
-            print('show_channel_id:',ctx.message.channel.id)
-            updateSettings = {'guild_id':settings[0][0],
-                                'types':settings[0][1],
-                                'lead_id':settings[0][2],
-                                'show_id':ctx.message.channel.id,
-                                'rec_id':settings[0][4],
-                                'lat_lon_center':settings[0][5],
-                                'lead_freq':settings[0][6],
-                                'show_freq':settings[0][7],
-                                'rec_freq':settings[0][8],
-                                'update_freq':settings[0][9]}
-            dataEntry('guildSettings',updateSettings)
-            await ctx.message.add_reaction('✅')
-        else:
-            print('show_channel_id:',ctx.message.channel.id)
-            update_settings = {'guild_id':guild_id, 'show_id':ctx.message.channel.id}
-            dataEntry('guildSettings',updateSettings)
-            await ctx.message.add_reaction('✅')
+        print('show_channel_id:',ctx.message.channel.id)
+        _updateGuildSettings(guild_id, {'show_id': ctx.message.channel.id})
+        _scheduleGuild(guild_id)
+        await ctx.message.add_reaction('✅')
     except:
         print('Could not set Showcase channel for guild:',ctx.guild.id)
 
@@ -1436,30 +3174,10 @@ async def setRecommended(ctx):
 
     try:
         guild_id = ctx.guild.id
-        settings = dataRead('guildSettings',
-                            ['guild_id','types',
-                             'lead_id','show_id','rec_id','lat_lon_center',
-                             'lead_freq','show_freq','rec_freq','update_freq'],
-                            cond_key='guild_id', cond_ineq='=', cond_value=guild_id)
-        if len(settings) > 0:
-            print('rec_channel_id:',ctx.message.channel.id)
-            updateSettings = {'guild_id':settings[0][0],
-                                'types':settings[0][1],
-                                'lead_id':settings[0][2],
-                                'show_id':settings[0][3],
-                                'rec_id':ctx.message.channel.id,
-                                'lat_lon_center':settings[0][5],
-                                'lead_freq':settings[0][6],
-                                'show_freq':settings[0][7],
-                                'rec_freq':settings[0][8],
-                                'update_freq':settings[0][9]}
-            dataEntry('guildSettings',updateSettings)
-            await ctx.message.add_reaction('✅')
-        else:
-            print('rec_channel_id:',ctx.message.channel.id)
-            update_settings = {'guild_id':guild_id, 'rec_id':ctx.message.channel.id}
-            dataEntry('guildSettings',updateSettings)
-            await ctx.message.add_reaction('✅')
+        print('rec_channel_id:',ctx.message.channel.id)
+        _updateGuildSettings(guild_id, {'rec_id': ctx.message.channel.id})
+        _scheduleGuild(guild_id)
+        await ctx.message.add_reaction('✅')
     except:
         print('Could not set recommended channel for guild:',ctx.guild.id)
 
@@ -1482,29 +3200,11 @@ async def center(ctx, *, lat_lon):
             lon = float(lat_lon.split(',')[1])
 
             if 90 >= lat >= -90 and 180 >= lon >= -180:
-                guild_id = ctx.guild.id
-                settings = dataRead('guildSettings',
-                                    ['guild_id','types',
-                                     'lead_id','show_id','rec_id','lat_lon_center',
-                                     'lead_freq','show_freq','rec_freq','update_freq'],
-                                    cond_key='guild_id', cond_ineq='=', cond_value=guild_id)
-                if len(settings) > 0:
-                    #print(lat_lon.strip())
-                    updateSettings = {'guild_id':settings[0][0],
-                                      'types':settings[0][1],
-                                      'lead_id':settings[0][2],
-                                      'show_id':settings[0][3],
-                                      'rec_id':settings[0][4],
-                                      'lat_lon_center':lat_lon.strip(),
-                                      'lead_freq':settings[0][6],
-                                      'show_freq':settings[0][7],
-                                      'rec_freq':settings[0][8],
-                                      'update_freq':settings[0][9]}
-                    dataEntry('guildSettings',updateSettings)
-                else:
-                    #print(lat_lon.strip())
-                    update_settings = {'guild_id':guild_id, 'lat_lon_center':lat_lon.strip()}
-                    dataEntry('guildSettings',updateSettings)
+                _updateGuildSettings(ctx.guild.id, {'lat_lon_center': '{},{}'.format(lat, lon)})
+                await ctx.message.add_reaction('✅')
+            else:
+                await ctx.send('not valid <lat,lon>')
+                print('not valid lat_lon')
         else:
             await ctx.send('not valid <lat,lon>')
             print('not valid lat_lon')
@@ -1512,6 +3212,37 @@ async def center(ctx, *, lat_lon):
         print('Could not set lat/lon center for guild:',ctx.guild.id)
 
 
+@client.command(aliases=['tz'])
+@commands.guild_only()
+@commands.has_permissions(manage_channels=True)
+async def timezone(ctx, *, tz):
+    '''Sets the time zone of the guild (the daily showcase starts a new day at midnight in it)
+
+    Inputs
+        tz : (type:str) IANA time zone name (ex: America/Denver)
+    '''
+
+    try:
+        guild_id = ctx.guild.id
+        tz = tz.strip()
+        if ZoneInfo is None:
+            await ctx.send('time zones are not supported by this bot (needs python 3.9+)')
+            return
+        try:
+            ZoneInfo(tz)
+        except Exception:
+            await ctx.send('not a valid time zone (ex: America/Denver)')
+            return
+
+        _updateGuildSettings(guild_id, {'tz': tz})
+        # the guild's current day may have changed
+        _showcase_queues.pop(guild_id, None)
+        _scheduleGuild(guild_id, ['rollover'])
+        await ctx.message.add_reaction('✅')
+    except:
+        print('Could not set time zone for guild:',ctx.guild.id)
+
+
 @client.command(aliases=['freq'])
 @commands.guild_only()
 @commands.has_permissions(manage_channels=True)
@@ -1532,32 +3263,11 @@ async def frequency(ctx, *, frequency):
                     show_freq = int(frequency.split(',')[1])
                     rec_freq = int(frequency.split(',')[2])
                     update_freq = int(frequency.split(',')[3])
-            
-                    settings = dataRead('guildSettings',
-                                        ['guild_id','types',
-                                         'lead_id','show_id','rec_id','lat_lon_center',
-                                         'lead_freq','show_freq','rec_freq','update_freq'],
-                                        cond_key='guild_id', cond_ineq='=', cond_value=guild_id)
-                    if len(settings) > 0:
-                        #print(frequency)
-                        updateSettings = {'guild_id':settings[0][0],
-                                          'types':settings[0][1],
-                                          'lead_id':settings[0][2],
-                                          'show_id':settings[0][3],
-                                          'rec_id':settings[0][4],
-                                          'lat_lon_center':settings[0][5],
-                                          'lead_freq':lead_freq,
-                                          'show_freq':show_freq,
-                                          'rec_freq':rec_freq,
-                                          'update_freq':update_freq}
-                        dataEntry('guildSettings',updateSettings)
-                        await ctx.message.add_reaction('✅')
-                    else:
-                        #print(frequency)
-                        updateSettings = {'guild_id':guild_id, 'lead_freq':lead_freq, 'show_freq':show_freq,
-                                          'rec_freq':rec_freq, 'update_freq':update_freq}
-                        dataEntry('guildSettings',updateSettings)
-                        await ctx.message.add_reaction('✅')
+
+                    _updateGuildSettings(guild_id, {'lead_freq':lead_freq, 'show_freq':show_freq,
+                                                    'rec_freq':rec_freq, 'update_freq':update_freq})
+                    _scheduleGuild(guild_id)
+                    await ctx.message.add_reaction('✅')
                 else:
                     await ctx.send('frequency not in range [1,24]')
             else:
@@ -1577,8 +3287,10 @@ async def frequency(ctx, *, frequency):
 # On Ready
 @client.event
 async def on_ready():
-    _removeExpiredTokens()
-    hourLoop.start()
+    _startTokenRefresher()
+    await _startWebhookServer()
+    _startEmbedWorker()
+    _startScheduler()
     print('\nBot is Online')
     print('\nReady For Other Operations:')
 
@@ -1605,124 +3317,210 @@ async def update_status():
     print('Changing Status')
 
 
-@tasks.loop(seconds=3600)
-async def hourLoop():
-    '''hourly bot updates'''
-    print('\nSTARTING HOURLY UPDATES:')
-    settings = dataRead('guildSettings',
-                        ['guild_id','types', 'lead_id','show_id','rec_id','lat_lon_center',
-                        'lead_freq','show_freq','rec_freq','update_freq'])
-    try:
-        iter_hour += 1
-        if iter_hour > 24:
-            iter_hour = 1
-    except:
-        iter_hour = int(datetime.datetime.now().strftime("%H"))
+# heap of (run_at, seq, guild_id, job) (guild_id is None for the daily/monthly resets)
+_schedule_heap = []
+_schedule_at = {}       # (guild_id, job) : run_at of its current heap entry (any other entry is stale)
+_schedule_seq = 0
+_guild_locks = {}       # guild_id : (type:asyncio.Lock) a guild's jobs run one at a time
+_schedule_wake = None   # (type:asyncio.Event) set when the schedule changes
+_schedule_task = None
 
-    try:
-        if cur_month != datetime.datetime.now().strftime("%m"):
-            cur_month = datetime.datetime.now().strftime("%m")
-            # clear user stats
-            discord_and_guild_ids = dataRead('userStats',['discord_id','guild_id'])
-            dataDelete('userStats')
-            print('deleted userStats:',len(discord_and_guild_ids))
-            for each in discord_and_guild_ids:
-                initStats = {'discord_id' : each[0],
-                             'dist':0,
-                             'time':0,
-                             'elev':0,
-                             'days':0,
-                             'guild_id':each[1]}
-                dataEntry('userStats',initStats)
-            # clear roles
-            for member in client.get_all_members():
-                for type in role_names:
-                    for limit in role_names[type]:
-                        try:
-                            role = discord.utils.get(member.guild.roles, name=role_names[type][limit])
-                            await member.remove_roles([role],reason='monthly userStats reset')
-                            print('Removed Roles. . .')
-                        except:
-                            print('Error removing role ({}) from {} in guild {} (id:{})'.format(role_names[type][limit],
-                                                                                        member.display_name,
-                                                                                        member.guild.name, member.guild.id))
-    except:
-        cur_month = datetime.datetime.now().strftime("%m")
 
+def _nextSlot(freq, now=None):
+    '''Returns the next hour (datetime) after now that is divisible by freq (freq in hours, 1-24)'''
+
+    now = datetime.datetime.now() if now is None else now
+    slot = now.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+    while slot.hour % freq != 0:
+        slot += datetime.timedelta(hours=1)
+    return slot
+
+
+def _schedule(guild_id, job, run_at):
+    '''Schedule (or move) a job
+
+    Inputs
+        guild_id : (server_id) id number of the guild (None for the global resets)
+        job : job name (key of guild_jobs, 'rollover', or 'monthly')
+        run_at : time (epoch seconds) to run the job
+    '''
+
+    global _schedule_seq
+    _schedule_seq += 1
+    _schedule_at[(guild_id, job)] = run_at
+    heapq.heappush(_schedule_heap, (run_at, _schedule_seq, guild_id, job))
+    if _schedule_wake is not None:
+        _schedule_wake.set()
+
+
+def _scheduleGuild(guild_id, jobs=None):
+    '''(Re)schedule the jobs of a guild from its current guildSettings (call after they change)
+
+    Inputs
+        guild_id : (server_id) id number of the guild
+        jobs (optional) : list of jobs to schedule (default: every job in guild_jobs, and 'rollover')
+    '''
 
+    settings = _guildSettings(guild_id)
 
-    if iter_hour % 24 == 0:
-        dataDelete('dailyActivities')
+    for job in list(guild_jobs) + ['rollover'] if jobs is None else jobs:
+        if job == 'rollover':
+            # the showcase queue starts a new day at midnight in the guild's time zone
+            _schedule(guild_id, job, _guildMidnight(guild_id))
+            continue
+        freq_col, channel_col = guild_jobs[job]
+        freq = getattr(settings, freq_col) if settings is not None else None
+        if freq is None or not 1 <= freq <= 24 or (channel_col is not None and getattr(settings, channel_col) is None):
+            # not configured (drops the job if it was scheduled)
+            _schedule_at.pop((guild_id, job), None)
+            continue
+        _schedule(guild_id, job, _nextSlot(freq).timestamp() + random.uniform(0, schedule_jitter))
 
 
-    #print(settings)
-    if len(settings) > 0:
-        for each in settings:
-            #print(each)
-            guild_id = each[0]
+def _scheduleResets():
+    '''Schedule the next monthly (userStats/roles) reset'''
+
+    midnight = _nextSlot(24)
+    month_start = datetime.datetime(midnight.year + midnight.month // 12, midnight.month % 12 + 1, 1)
+    if midnight.day == 1:
+        month_start = midnight
+    _schedule(None, 'monthly', month_start.timestamp())
+
+
+def _resetMissed():
+    '''Returns True if the current month's reset hasn't run (ex: the bot was offline on the 1st)'''
+
+    row = dataRead('botState', ['value'], cond_key='name', cond_ineq='=', cond_value='last_reset', fetchOne=True)
+    return row is not None and row[0] != datetime.date.today().strftime('%Y-%m')
+
+
+async def _monthlyReset():
+    '''Clear every userStats row and the monthly roles (start of a new month)
+
+    The month of the reset is recorded in botState. A reset caught up after the 1st (see
+    _startScheduler) totals the month's activities so far again.
+    '''
 
-            # update userActivities
-            if each[9] != None and each[9] != 'None':
+    today = datetime.date.today()
+
+    # clear user stats
+    discord_and_guild_ids = dataRead('userStats',['discord_id','guild_id'])
+    _invalidateLeaderboard()
+    with transaction():
+        dataDelete('userStats')
+        print('deleted userStats:',len(discord_and_guild_ids))
+        dataEntryMany('userStats', [{'discord_id' : each[0],
+                                     'dist':0,
+                                     'time':0,
+                                     'elev':0,
+                                     'days':0,
+                                     'guild_id':each[1]} for each in discord_and_guild_ids])
+        dataEntry('botState', {'name': 'last_reset', 'value': today.strftime('%Y-%m')})
+    if today.day != 1:
+        for guild_id in list(_guildSettingsCache()):
+            _updateUserStats(guild_id)
+    # clear roles
+    for member in client.get_all_members():
+        for type in role_names:
+            for limit in role_names[type]:
                 try:
-                    if iter_hour % each[9] == 0:
-                        print('updating activities')
-                        _updateUserActivities(guild_id, num_activities=99)
-                        _updateUserStats(guild_id)
-                        _updateDailyActivities(guild_id)
+                    role = discord.utils.get(member.guild.roles, name=role_names[type][limit])
+                    await member.remove_roles([role],reason='monthly userStats reset')
+                    print('Removed Roles. . .')
                 except:
-                    print('Error Updating User Activities')
-
-            # send recommendedActivities
-            if each[8] != None and each[4] != None and each[8] != 'None' and each[4] != 'None':
-                if iter_hour % each[8] == 0:
-                    try:
-                        print('posting recommended activities')
-                        rec_channel = await client.fetch_channel(each[4])
-                        guild = await client.fetch_guild(guild_id)
-                        await _showRecommended(guild, channel_id=each[4])
-                    except Exception as exc:
-                        print(exc)
-                        print('Error in Sending Recommended Activities')
-            else:
-                print('recommendedActivities frequency or channel_id not defined')
-
-            # send activity showcase
-            if each[7] != None and each[3] != None and each[7] != 'None' and each[3] != 'None':
-                if iter_hour % each[7] == 0:
-                    guild = await client.fetch_guild(guild_id)
-                    try:
-                        print('posting daily showcase')
-                        show_channel = await client.fetch_channel(each[3])
-                        await _dailyRunningShowcase(guild, channel_id=each[3])
-                    except:
-                        print('Error in Sending Showcase Activities')
-            else:
-                print('showcase frequency or channel_id not defined')
-
-            # send activity leaderboard
-            if each[6] != None and each[2] != None and each[6] != 'None' and each[2] != 'None':
-                if iter_hour % each[6] == 0:
-                    guild = await client.fetch_guild(guild_id)
-                    try:
-                        print('posting leaderboard')
-                        leaderboard_channel = await client.fetch_channel(each[2])
-                        leaderboard_embed = _createLeaderboard(guild.id)
-                        leaderboard_msg = await leaderboard_channel.send(embed=leaderboard_embed)
-                        await leaderboard_msg.add_reaction('📏') #dist
-                        await leaderboard_msg.add_reaction('⌚') #time
-                        await leaderboard_msg.add_reaction('🪜')  #elev
-                        await leaderboard_msg.add_reaction('🗓') #days
-                    except:
-                        print('Error in Sending Leaderboard')
+                    print('Error removing role ({}) from {} in guild {} (id:{})'.format(role_names[type][limit],
+                                                                                member.display_name,
+                                                                                member.guild.name, member.guild.id))
+
+
+async def _guildJob(guild_id, job):
+    '''Run one of a guild's jobs (update activities, recommended routes, showcase, leaderboard, showcase rollover)'''
+
+    settings = _guildSettings(guild_id)
+    if settings is None:
+        return
+
+    if job == 'update':
+        # members synced this interval (ex: by another guild's update) are not fetched again
+        print('updating activities')
+        max_age = max(0, (settings.update_freq or 1) * 3600 - 2 * schedule_jitter)
+        await _ensureSynced(_guildMembers(guild_id), max_age=max_age, poll=_webhook_runner is None)
+        _checkUserStats(guild_id)
+    elif job == 'rec':
+        print('posting recommended activities')
+        guild = await client.fetch_guild(guild_id)
+        await _showRecommended(guild, channel_id=settings.rec_id)
+    elif job == 'show':
+        print('posting daily showcase')
+        guild = await client.fetch_guild(guild_id)
+        await _dailyRunningShowcase(guild, channel_id=settings.show_id)
+    elif job == 'lead':
+        print('posting leaderboard')
+        leaderboard_channel = await client.fetch_channel(settings.lead_id)
+        await _postLeaderboard(leaderboard_channel, guild_id)
+    elif job == 'rollover':
+        _rolloverShowcase(guild_id)
+
+
+async def _runJob(guild_id, job):
+    '''Run a scheduled job (one at a time per guild) and schedule its next run'''
+
+    lock = _guild_locks.setdefault(guild_id, asyncio.Lock())
+    async with lock:
+        try:
+            if job == 'monthly':
+                await _monthlyReset()
             else:
-                print('leaderboard frequency or channel_id not defined')
+                await _guildJob(guild_id, job)
+        except Exception as exc:
+            print('Error in {} job for guild {} ({})'.format(job, guild_id, exc))
 
-            
+    if guild_id is None:
+        _scheduleResets()
+    elif (guild_id, job) not in _schedule_at:
+        # next run (unless it was rescheduled, or unset, while this one ran)
+        _scheduleGuild(guild_id, [job])
 
 
+async def _scheduler():
+    '''Run guild jobs as they come due (runs for the lifetime of the bot)
+
+    Jobs run concurrently as their own tasks, so one slow guild doesn't hold up the others
+    '''
+
+    while True:
+        _schedule_wake.clear()
+        while len(_schedule_heap) > 0 and _schedule_heap[0][0] <= time.time():
+            run_at, seq, guild_id, job = heapq.heappop(_schedule_heap)
+            if _schedule_at.get((guild_id, job)) != run_at:
+                continue
+            del _schedule_at[(guild_id, job)]
+            asyncio.ensure_future(_runJob(guild_id, job))
+
+        # sleep until the next job is due (or the schedule changes)
+        timer = None
+        if len(_schedule_heap) > 0:
+            timer = asyncio.get_running_loop().call_later(max(0, _schedule_heap[0][0] - time.time()), _schedule_wake.set)
+        try:
+            await _schedule_wake.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
 
 
+def _startScheduler():
+    '''Schedule every guild's jobs and start the scheduler (once)'''
 
+    global _schedule_task, _schedule_wake
+    if _schedule_task is None or _schedule_task.done():
+        _schedule_wake = asyncio.Event()
+        _scheduleResets()
+        if _resetMissed():
+            print('Monthly reset was missed, running it now')
+            _schedule(None, 'monthly', time.time())
+        for guild_id in list(_guildSettingsCache()):
+            _scheduleGuild(guild_id)
+        _schedule_task = asyncio.ensure_future(_scheduler())
 
 
 # ==================================================== #
@@ -1730,4 +3528,16 @@ async def hourLoop():
 # ==================================================== #
 
 
-client.run(bot_token)
+def init():
+    '''Open the database and load the bot's credentials
+
+    (not done on import: compute pool workers started with spawn/forkserver re-import this
+    module, and must not reopen/migrate the database or print the credentials again)
+    '''
+    openDatabase()
+    loadBotInfo()
+
+
+if __name__ == "__main__":
+    init()
+    client.run(bot_token)
@@ -0,0 +1,295 @@
+import array
+import itertools
+import math
+import sys
+import zlib
+
+import polyline
+
+
+# Route geometry for strava_bot.py's public route catalog
+#
+# Polylines are simplified (Douglas-Peucker) into a canonical geometry, and two routes are
+# near-duplicates when their lengths are close and every part of each one runs within a
+# tolerance of the other (the same loop recorded by different athletes, from any start point
+# or in either direction). Candidates are found by a spatial hash of their centroids (cell),
+# and points are compared through a spatial hash grid so a match check is linear in points.
+#
+# Maps: polylines are simplified to the detail visible at the zoom a map is drawn at (see
+# simplify_for_map) before they go into google static map urls (the projection helpers are
+# shared with strava_render.py).
+#
+# Storage: pack/unpack convert a path to/from a compact blob, the int32 deltas between
+# consecutive points (1e-5 degrees, the precision of encoded polylines) compressed with zlib.
+# (raw int32 deltas are larger than polyline text, the small deltas compress very well)
+#
+# Distances are in meters on a local equirectangular projection (fine at route scale).
+# Nothing here touches the network or the bot's database.
+
+
+meters_per_lat = 110540.0
+meters_per_lon = 111320.0   # at the equator (scaled by cos(lat))
+match_samples = 64          # points of each route checked against the other route
+match_spacing = 10          # spacing (m) of the points the checked points are compared to
+match_grid = 50             # spatial hash grid size (m) used to find nearby points
+earth_radius = 6378137.0    # meters (web mercator sphere)
+tile_size = 256
+max_zoom = 17
+
+
+def to_xy(points, origin):
+    '''Project lat/lon points to meters (x east, y north) around an origin (lat, lon)'''
+
+    scale = meters_per_lon * math.cos(math.radians(origin[0]))
+    return [((lon - origin[1]) * scale, (lat - origin[0]) * meters_per_lat) for lat, lon in points]
+
+
+def project(lat, lon):
+    '''Web mercator projection of a point onto the unit square (zoom 0 world)'''
+
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = (lon + 180) / 360
+    y = (1 - math.log(math.tan(math.radians(lat)) + 1 / math.cos(math.radians(lat))) / math.pi) / 2
+    return x, y
+
+
+def fit_zoom(bounds, width, height, padding):
+    '''Returns the largest integer zoom at which bounds (min_x, min_y, max_x, max_y) fit the canvas'''
+
+    dx = max(bounds[2] - bounds[0], 1e-12)
+    dy = max(bounds[3] - bounds[1], 1e-12)
+    scale = min((width - 2*padding) / dx, (height - 2*padding) / dy) / tile_size
+    if scale < 1:
+        return 0
+    return min(int(math.log2(scale)), max_zoom)
+
+
+def meters_per_pixel(zoom, lat):
+    '''Ground size (m) of a map pixel at a zoom level and latitude'''
+    return 2 * math.pi * earth_radius * math.cos(math.radians(lat)) / (tile_size * 2**zoom)
+
+
+def path_length(xy):
+    '''Length (m) of a projected path'''
+    return sum(math.hypot(b[0] - a[0], b[1] - a[1]) for a, b in zip(xy, xy[1:]))
+
+
+def _segment_distance(p, a, b):
+    '''Distance from point p to the segment ab (projected points)'''
+
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    if dx == 0 and dy == 0:
+        return math.hypot(p[0] - a[0], p[1] - a[1])
+    t = max(0, min(1, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / (dx*dx + dy*dy)))
+    return math.hypot(p[0] - a[0] - t*dx, p[1] - a[1] - t*dy)
+
+
+def simplify(points, tolerance):
+    '''Douglas-Peucker simplification of a lat/lon path
+
+    Inputs
+        points : list of (lat, lon) points
+        tolerance : max distance (m) of a removed point from the simplified path
+    Returns
+        points : the kept (lat, lon) points (first and last are always kept)
+    '''
+
+    if len(points) < 3:
+        return list(points)
+    xy = to_xy(points, points[0])
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        worst, index = 0, None
+        for i in range(first + 1, last):
+            d = _segment_distance(xy[i], xy[first], xy[last])
+            if d > worst:
+                worst, index = d, i
+        if index is not None and worst > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [p for p, k in zip(points, keep) if k]
+
+
+def simplify_for_map(poly_list, m_size='640x640', padding=24, pixels=0.5):
+    '''Simplify encoded polylines to the detail visible on a map fitted to all of them
+
+    Inputs
+        poly_list : list of encoded polylines
+        m_size (optional) : map size (WIDTHxHEIGHT)
+        padding (optional) : minimum space (pixels) between the tracks and the map border
+        pixels (optional) : simplification tolerance in pixels at the map's zoom
+    Returns
+        poly_list : the simplified encoded polylines (same order, empty ones are kept as is)
+    '''
+
+    tracks = [polyline.decode(poly) if poly else [] for poly in poly_list]
+    points = [p for track in tracks for p in track]
+    if len(points) == 0:
+        return list(poly_list)
+
+    width, height = (int(x) for x in m_size.lower().split('x'))
+    xy = [project(lat, lon) for lat, lon in points]
+    bounds = (min(p[0] for p in xy), min(p[1] for p in xy), max(p[0] for p in xy), max(p[1] for p in xy))
+    zoom = fit_zoom(bounds, width, height, padding)
+    tolerance = pixels * meters_per_pixel(zoom, sum(p[0] for p in points) / len(points))
+    return [polyline.encode(simplify(track, tolerance)) if len(track) > 0 else poly
+            for track, poly in zip(tracks, poly_list)]
+
+
+def resample(xy, count):
+    '''Returns count points evenly spaced (by distance) along a projected path'''
+
+    if len(xy) < 2:
+        return list(xy) * count
+    total = path_length(xy)
+    if total == 0:
+        return [xy[0]] * count
+    step = total / (count - 1)
+    samples = [xy[0]]
+    walked, target, i = 0, step, 0
+    while len(samples) < count - 1 and i < len(xy) - 1:
+        a, b = xy[i], xy[i + 1]
+        seg = math.hypot(b[0] - a[0], b[1] - a[1])
+        if seg > 0 and walked + seg >= target:
+            t = (target - walked) / seg
+            samples.append((a[0] + t * (b[0] - a[0]), a[1] + t * (b[1] - a[1])))
+            target += step
+        else:
+            walked += seg
+            i += 1
+    samples.append(xy[-1])
+    return samples
+
+
+def cell(lat, lon, cell_size):
+    '''Spatial hash of a point (grid cell of cell_size degrees)'''
+    return '{}:{}'.format(math.floor(lat / cell_size), math.floor(lon / cell_size))
+
+
+def neighbor_cells(lat, lon, cell_size):
+    '''The cell of a point and the 8 cells around it'''
+
+    row, col = math.floor(lat / cell_size), math.floor(lon / cell_size)
+    return ['{}:{}'.format(row + i, col + j) for i in (-1, 0, 1) for j in (-1, 0, 1)]
+
+
+def describe(poly, tolerance, cell_size):
+    '''Canonical geometry of an encoded polyline
+
+    Inputs
+        poly : encoded polyline
+        tolerance : simplification tolerance (m)
+        cell_size : spatial hash cell size (degrees)
+    Returns
+        geometry : dictionary with the simplified polyline, its length (m), bounding box,
+                   centroid, and centroid cell (None if the polyline has no points)
+    '''
+
+    points = polyline.decode(poly) if poly else []
+    if len(points) == 0:
+        return None
+    lats = [p[0] for p in points]
+    lons = [p[1] for p in points]
+    center = (sum(lats) / len(lats), sum(lons) / len(lons))
+    return {'polyline': polyline.encode(simplify(points, tolerance)),
+            'length': path_length(to_xy(points, center)),
+            'min_lat': min(lats), 'max_lat': max(lats), 'min_lon': min(lons), 'max_lon': max(lons),
+            'center_lat': center[0], 'center_lon': center[1],
+            'cell': cell(center[0], center[1], cell_size)}
+
+
+def _directed_distance(a, b, grid_size):
+    '''Mean and max distance from the points of a to their nearest point of b (b hashed into a grid)'''
+
+    grid = {}
+    for p in b:
+        grid.setdefault((math.floor(p[0] / grid_size), math.floor(p[1] / grid_size)), []).append(p)
+
+    total = worst = 0
+    for p in a:
+        gx, gy = math.floor(p[0] / grid_size), math.floor(p[1] / grid_size)
+        near = [q for i in (-1, 0, 1) for j in (-1, 0, 1) for q in grid.get((gx + i, gy + j), [])]
+        if len(near) == 0:
+            # nothing within a grid cell, fall back to the full search
+            near = b
+        d = min(math.hypot(p[0] - q[0], p[1] - q[1]) for q in near)
+        total += d
+        worst = max(worst, d)
+    return total / len(a), worst
+
+
+def match_distance(poly_a, poly_b, samples=match_samples):
+    '''How far apart two routes are (m): the mean and the max distance from points along one
+    route to the other, each the larger of the two directions (about 0 for the same path,
+    regardless of start point or direction, the max catches a detour the mean averages out)'''
+
+    a, b = polyline.decode(poly_a), polyline.decode(poly_b)
+    if len(a) == 0 or len(b) == 0:
+        return math.inf, math.inf
+    origin = a[0]
+    a, b = to_xy(a, origin), to_xy(b, origin)
+
+    def dense(xy):
+        return resample(xy, min(int(path_length(xy) / match_spacing) + 2, 5000))
+
+    a_to_b = _directed_distance(resample(a, samples), dense(b), match_grid)
+    b_to_a = _directed_distance(resample(b, samples), dense(a), match_grid)
+    return max(a_to_b[0], b_to_a[0]), max(a_to_b[1], b_to_a[1])
+
+
+def find_match(poly, candidates, tolerance, deviation):
+    '''Returns the id of the first candidate that is the same route as poly (None if none is)
+
+    Inputs
+        poly : encoded polyline of the route
+        candidates : list of (id, encoded polyline) of the routes to check
+        tolerance : max mean distance (m) of the same route (see match_distance)
+        deviation : max distance (m) of any point of the same route (see match_distance)
+    '''
+
+    for key, other in candidates:
+        mean, worst = match_distance(poly, other)
+        if mean <= tolerance and worst <= deviation:
+            return key
+    return None
+
+
+def pack(points):
+    '''Compact binary form of a lat/lon path (zlib compressed int32 deltas in 1e-5 degrees)'''
+
+    values = array.array('i')
+    prev_lat = prev_lon = 0
+    for lat, lon in points:
+        lat, lon = round(lat * 1e5), round(lon * 1e5)
+        values.append(lat - prev_lat)
+        values.append(lon - prev_lon)
+        prev_lat, prev_lon = lat, lon
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return zlib.compress(values.tobytes())
+
+
+def unpack(blob):
+    '''Returns the lat/lon points of a packed path (see pack)'''
+
+    values = array.array('i')
+    values.frombytes(zlib.decompress(blob))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    lats = itertools.accumulate(values[0::2])
+    lons = itertools.accumulate(values[1::2])
+    return [(lat / 1e5, lon / 1e5) for lat, lon in zip(lats, lons)]
+
+
+def pack_polyline(poly):
+    '''Packed form of an encoded polyline (None if it is empty)'''
+    return pack(polyline.decode(poly)) if poly else None
+
+
+def unpack_polyline(blob):
+    '''Encoded polyline of a packed path (None if there is no path)'''
+    return polyline.encode(unpack(blob)) if blob else None
@@ -0,0 +1,167 @@
+import io
+import os
+
+import polyline
+
+from strava_geometry import tile_size, project, fit_zoom
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:     # the local renderer is optional (strava_bot.py falls back to google static maps)
+    Image = None
+
+
+# CPU-bound rendering for strava_bot.py, run in its compute pool (see runCompute)
+#
+# Offline map renderer (map_renderer = 'local'):
+# Draws encoded polylines onto a web-mercator canvas fitted to the tracks. If map tiles
+# have been saved locally as {tile_dir}/{maptype}/{z}/{x}/{y}.png (standard slippy map
+# layout, 256px tiles) they are used as the background, otherwise a plain one is drawn.
+#
+# Leaderboard text: the sorted rank/name/stat columns of a leaderboard embed (for every sort).
+#
+# Nothing here touches the network or the bot's database, so it can run in any worker.
+
+
+background = (236, 234, 228)
+default_colors = ['0xFC4C02FF']     # strava orange (single activity maps)
+
+# sort : (userStats column index, embed field name, value formatter)
+leaderboard_stats = {'dist': (1, 'Distance (mi)', lambda x: round(x/1609, 2)),
+                     'time': (2, 'Time (hr)', lambda x: round(x/3600, 2)),
+                     'elev': (3, 'Elev Gain (ft)', lambda x: round(x, 2)),
+                     'days': (4, 'Active Days', lambda x: round(x, 2))}
+
+
+def available():
+    '''Returns whether the local renderer can be used (Pillow is installed)'''
+    return Image is not None
+
+
+def parse_color(color):
+    '''Convert a google static maps color (0xRRGGBB or 0xRRGGBBAA) into an RGBA tuple'''
+
+    color = color.lower().replace('0x', '')
+    if len(color) == 6:
+        color += 'ff'
+    if len(color) != 8:
+        raise ValueError('Invalid color: {}'.format(color))
+    return tuple(int(color[i:i+2], 16) for i in range(0, 8, 2))
+
+
+def parse_size(m_size):
+    '''Convert a WIDTHxHEIGHT string into a (width, height) tuple'''
+
+    width, height = m_size.lower().split('x')
+    return int(width), int(height)
+
+
+def _draw_tiles(image, tile_dir, zoom, center, width, height):
+    '''Paste the locally saved tiles covering the canvas (returns the number of tiles drawn)'''
+
+    world = tile_size * 2**zoom
+    left = center[0] * world - width / 2
+    top = center[1] * world - height / 2
+    drawn = 0
+    for tx in range(int(left // tile_size), int((left + width) // tile_size) + 1):
+        for ty in range(int(top // tile_size), int((top + height) // tile_size) + 1):
+            if ty < 0 or ty >= 2**zoom:
+                continue
+            path = os.path.join(tile_dir, str(zoom), str(tx % 2**zoom), '{}.png'.format(ty))
+            if not os.path.isfile(path):
+                continue
+            with Image.open(path) as tile:
+                image.paste(tile.convert('RGB'), (int(tx * tile_size - left), int(ty * tile_size - top)))
+            drawn += 1
+    return drawn
+
+
+def render_polylines(poly_list, colors=None, m_size='640x640', maptype='roadmap', tile_dir=None,
+                     line_width=4, padding=24):
+    '''Render encoded polylines into a png image
+
+    Inputs
+        poly_list : list of encoded polylines
+        colors (optional) : google static maps colors of each polyline (defaults to strava orange)
+        m_size (optional) : image size (WIDTHxHEIGHT)
+        maptype (optional) : tile set to use as the background (subdirectory of tile_dir)
+        tile_dir (optional) : directory of locally saved map tiles
+        line_width (optional) : width of the drawn tracks (pixels)
+        padding (optional) : minimum space (pixels) between the tracks and the image border
+    Returns
+        data : png bytes of the rendered image
+    '''
+
+    if not available():
+        raise RuntimeError('Pillow is not installed')
+
+    width, height = parse_size(m_size)
+    colors = colors or default_colors
+    # (empty polylines are skipped along with their color, so each track keeps its own color)
+    tracks = [([project(lat, lon) for lat, lon in polyline.decode(poly)], colors[i % len(colors)])
+              for i, poly in enumerate(poly_list) if poly]
+    points = [point for track, color in tracks for point in track]
+
+    image = Image.new('RGB', (width, height), background)
+    if len(points) == 0:
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    bounds = (min(p[0] for p in points), min(p[1] for p in points),
+              max(p[0] for p in points), max(p[1] for p in points))
+    center = ((bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2)
+    zoom = fit_zoom(bounds, width, height, padding)
+    world = tile_size * 2**zoom
+
+    if tile_dir is not None:
+        _draw_tiles(image, os.path.join(tile_dir, maptype), zoom, center, width, height)
+
+    # tracks are drawn on a transparent layer so the alpha of each color is respected
+    overlay = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+    for track, color in tracks:
+        pixels = [((x - center[0]) * world + width / 2, (y - center[1]) * world + height / 2) for x, y in track]
+        color = parse_color(color)
+        if len(pixels) > 1:
+            draw.line(pixels, fill=color, width=line_width, joint='curve')
+        for (px, py), marker in [(pixels[0], (0, 160, 0, 255)), (pixels[-1], (200, 0, 0, 255))]:
+            r = line_width + 1
+            draw.ellipse([px - r, py - r, px + r, py + r], fill=marker, outline=(255, 255, 255, 255))
+
+    image = Image.alpha_composite(image.convert('RGBA'), overlay).convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def leaderboard_fields(user_data, usernames, sort='dist'):
+    '''Sort userStats rows and build the text of each leaderboard column
+
+    Inputs
+        user_data : list of userStats rows (discord_id, dist, time, elev, days)
+        usernames : dictionary of discord_id : username
+        sort (optional) : the stat the leaderboard is sorted by (dist, time, elev, days)
+    Returns
+        fields : list of (field name, field text) for the Rank, Name, and sorted stat columns
+    '''
+
+    if sort not in leaderboard_stats:
+        raise ValueError('Bad sort input')
+    col, title, fmt = leaderboard_stats[sort]
+
+    sorted_data = sorted(user_data, key=lambda x: x[col], reverse=True)
+    rank = ''.join('#{}\n'.format(i + 1) for i in range(len(sorted_data)))
+    name = ''.join('{}\n'.format(usernames.get(each[0], each[0])) for each in sorted_data)
+    value = ''.join('{}\n'.format(fmt(each[col])) for each in sorted_data)
+    return [('Rank', rank), ('Name', name), (title, value)]
+
+
+def leaderboard_columns(user_data, usernames):
+    '''Build the leaderboard columns of every sort (see leaderboard_fields)
+
+    Returns
+        columns : dictionary of sort : leaderboard_fields of that sort
+    '''
+
+    return {sort: leaderboard_fields(user_data, usernames, sort) for sort in leaderboard_stats}